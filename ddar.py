@@ -16,12 +16,19 @@
 """The logic core of AlphaGeometry2."""
 
 import collections
+import collections.abc
+import dataclasses
 import fractions
 import itertools
+import json
+import math
+import time
+
+import numpy as np
 
 import elimination as el
 import numericals as ng
-from parse import AGPoint
+from parse import AGPoint, AGPredicate
 
 
 Fraction = fractions.Fraction
@@ -30,6 +37,157 @@ NumCircle = ng.NumCircle
 NumLine = ng.NumLine
 
 
+class PairTable(collections.abc.MutableMapping):
+  """Symmetric table indexed by pairs of points, stored as an n x n array.
+
+  `index` maps the points to their rows and is shared by all the tables of
+  a DDAR; (a, b) and (b, a) are the same entry. The inner loops may index
+  `rows` directly.
+  """
+
+  def __init__(self, index):
+    self.index = index
+    self.points = list(index)
+    self.rows = [[None] * len(index) for _ in index]
+    self.size = 0
+
+  def __getitem__(self, key):
+    a, b = key
+    value = self.rows[self.index[a]][self.index[b]]
+    if value is None:
+      raise KeyError(key)
+    return value
+
+  def get(self, key, default=None):
+    a, b = key
+    value = self.rows[self.index[a]][self.index[b]]
+    return default if value is None else value
+
+  def __contains__(self, key):
+    a, b = key
+    return self.rows[self.index[a]][self.index[b]] is not None
+
+  def __setitem__(self, key, value):
+    a, b = key
+    i = self.index[a]
+    j = self.index[b]
+    if self.rows[i][j] is None:
+      self.size += 1 if i == j else 2
+    self.rows[i][j] = value
+    self.rows[j][i] = value
+
+  def __delitem__(self, key):
+    a, b = key
+    i = self.index[a]
+    j = self.index[b]
+    if self.rows[i][j] is None:
+      raise KeyError(key)
+    self.size -= 1 if i == j else 2
+    self.rows[i][j] = None
+    self.rows[j][i] = None
+
+  def __iter__(self):
+    for a, row in zip(self.points, self.rows):
+      for b, value in zip(self.points, row):
+        if value is not None:
+          yield a, b
+
+  def __len__(self):
+    return self.size
+
+  def copy(self):
+    res = PairTable(self.index)
+    res.rows = [list(row) for row in self.rows]
+    res.size = self.size
+    return res
+
+
+class PairClasses:
+  """Inverted index of a simplified pair quantity: value -> point pairs.
+
+  Kept up to date with the elimination `version` and the DDAR `points`
+  version it was last refreshed at, see DDAR.update_pair_classes.
+  """
+
+  def __init__(self):
+    self.classes = dict()  # simplified value -> set of pairs
+    self.values = dict()  # pair -> simplified value
+    self.version = 0
+    self.points_version = 0
+
+  def move(self, pair, value):
+    """Sets the value of a pair, moving it to the class of the value."""
+    self.remove(pair)
+    self.values[pair] = value
+    self.classes.setdefault(value, set()).add(pair)
+
+  def remove(self, pair):
+    value = self.values.pop(pair, None)
+    if value is None:
+      return
+    pairs = self.classes[value]
+    pairs.discard(pair)
+    if not pairs:
+      del self.classes[value]
+
+
+class PointUnion(collections.abc.Mapping):
+  """Union-find of the merged points, maps a point to its representative.
+
+  Every link carries the bitset of constraints the merge relied on; paths
+  are compressed with their bitsets OR-ed, so that `deps(x)` is the
+  provenance of substituting x. The writes are recorded in `undo_log` if
+  set (see DDAR.checkpoint).
+  """
+
+  def __init__(self, points):
+    self.parent = {x: x for x in points}
+    self.link_deps = {x: 0 for x in points}
+    self.undo_log = None
+
+  def __getitem__(self, x):
+    parent = self.parent
+    path = []
+    while parent[x] is not x:
+      path.append(x)
+      x = parent[x]
+    root = x
+    if len(path) > 1:
+      deps = self.link_deps[path[-1]]
+      for y in reversed(path[:-1]):
+        deps |= self.link_deps[y]
+        self._set(parent, y, root)
+        self._set(self.link_deps, y, deps)
+    return root
+
+  def __iter__(self):
+    return iter(self.parent)
+
+  def __len__(self):
+    return len(self.parent)
+
+  def deps(self, x):
+    """Constraints used by substituting x with its representative."""
+    if self[x] is x:
+      return 0
+    return self.link_deps[x]  # linked to the root by the compression
+
+  def union(self, a, b, deps=0):
+    """Links the representative of b below the one of a."""
+    a = self[a]
+    b = self[b]
+    if a is b:
+      return False
+    self._set(self.parent, b, a)
+    self._set(self.link_deps, b, deps)
+    return True
+
+  def _set(self, table, key, value):
+    if self.undo_log is not None:
+      self.undo_log.append((table, key, table[key]))
+    table[key] = value
+
+
 class FormalLine:
   """Points known to be collinear (immutable)."""
 
@@ -39,12 +197,14 @@ class FormalLine:
       main_pair: tuple[AGPoint, AGPoint],
       direction: el.FormalAngle,
       value: NumLine,
+      deps: int = 0,
   ):
     assert len(points) > 1
     self.points = points
     self.main_pair = main_pair
     self.direction = direction
     self.value = value
+    self.deps = deps  # constraints the collinearity relies on
 
 
 class FormalCircle:
@@ -56,45 +216,186 @@ class FormalCircle:
       points: list[AGPoint],
       centers: list[AGPoint],
       value: NumCircle,
+      deps: int = 0,
   ):
     self.defining_points = defining_points
     self.points = points
     self.centers = centers
     self.value = value
+    self.deps = deps  # constraints the concyclicity relies on
+
+
+@dataclasses.dataclass
+class Budget:
+  """Limits of a deduction closure, None meaning unlimited."""
+
+  timeout: float | None = None  # wall-clock seconds from the start
+  max_rounds: int | None = None
+  max_constraints: int | None = None
+  # points and lines only merge during the closure: these two bound the
+  # size of the input, checked once before the first round
+  max_points: int | None = None
+  max_lines: int | None = None
+  max_circles: int | None = None
+
+
+class BudgetExceeded(Exception):
+  """Raised at a safe point of a rule once a budget limit is hit."""
+
+  def __init__(self, status):
+    super().__init__(status)
+    self.status = status
+
+
+# closure statuses: the fixpoint was reached, or the closure was cut off
+# by the budget limit of the given name
+FIXPOINT = 'fixpoint'
+TIMEOUT = 'timeout'
+MAX_ROUNDS = 'max_rounds'
+MAX_CONSTRAINTS = 'max_constraints'
+MAX_POINTS = 'max_points'
+MAX_LINES = 'max_lines'
+MAX_CIRCLES = 'max_circles'
+
+# pair quantities with an index of equal values, see DDAR.pair_classes
+PAIR_QUANTITIES = ('dist_mul', 'dist_add', 'direction')
+
+# quantities each kind of similarity signature is computed from: equal
+# ratios (sss) or equal angles (aa) alone already make triangles similar
+SIMILAR_PREMISES = dict(
+    sss=('dist_mul',),
+    aa=('direction',),
+    sas=('direction', 'dist_mul'),
+    ssa=('direction', 'dist_mul'),
+)
+
+# predicates produced by DDAR.enumerate_facts
+FACT_KINDS = frozenset(
+    ('coll', 'cyclic', 'para', 'perp', 'cong', 'eqangle', 'eqratio')
+)
+
+
+@dataclasses.dataclass
+class RuleStats:
+  """Counters of one rule during one round of the closure."""
+
+  rule: str
+  round: int
+  time: float = 0.0  # wall time in seconds
+  candidates: int = 0  # e.g. triangles checked
+  collisions: int = 0  # candidates matching, i.e. inferences tried
+  forced: int = 0  # constraints registered
+  changed: int = 0  # constraints which changed the state
+
+
+class ClosureStats:
+  """Statistics of a deduction closure, per rule and per round."""
+
+  def __init__(self):
+    self.rounds = []  # list of rounds, each a list of RuleStats
+    self.status = None  # of the closure, FIXPOINT if not cut off
+
+  def start_round(self):
+    self.rounds.append([])
+
+  def start_rule(self, rule):
+    stats = RuleStats(rule=rule, round=len(self.rounds) - 1)
+    self.rounds[-1].append(stats)
+    return stats
+
+  def totals(self):
+    """Sums the counters of every rule over the rounds."""
+    totals = dict()
+    for stats in itertools.chain.from_iterable(self.rounds):
+      total = totals.setdefault(stats.rule, RuleStats(stats.rule, -1))
+      total.time += stats.time
+      total.candidates += stats.candidates
+      total.collisions += stats.collisions
+      total.forced += stats.forced
+      total.changed += stats.changed
+    return totals
+
+  def to_dict(self):
+    return {
+        'status': self.status,
+        'rounds': [
+            [dataclasses.asdict(stats) for stats in rules]
+            for rules in self.rounds
+        ],
+        'totals': {
+            rule: dataclasses.asdict(stats)
+            for rule, stats in self.totals().items()
+        },
+    }
+
+  def to_json(self, **kwargs):
+    return json.dumps(self.to_dict(), **kwargs)
 
 
 class DDAR:
   """Main logical engine."""
 
-  def __init__(self, points):
+  def __init__(self, points, fingerprint=True, pivoting='usage'):
 
     self.points = list(points)
     assert all(isinstance(point, AGPoint) for point in points)
     self.lines = set()
     self.circles = set()
+    # incidence indexes: point -> lines through it, and point -> circles
+    # having it on the circumference or as a center
+    self.point_to_lines = {x: set() for x in self.points}
+    self.point_to_circles = {x: set() for x in self.points}
+
+    # fingerprints give check_pred a cheap negative answer; `pivoting` is
+    # either one strategy for all the systems, or a dict of them keyed by
+    # 'dist_mul', 'dist_add' and 'angle'
+    if isinstance(pivoting, str):
+      pivoting = dict.fromkeys(('dist_mul', 'dist_add', 'angle'), pivoting)
+    self.elim_dist_mul = el.ElimDistMul(
+        fingerprint=fingerprint, pivoting=pivoting['dist_mul']
+    )
+    self.elim_dist_add = el.ElimDistAdd(
+        fingerprint=fingerprint, pivoting=pivoting['dist_add']
+    )
+    self.elim_angle = el.ElimAngle(
+        fingerprint=fingerprint, pivoting=pivoting['angle']
+    )
 
-    self.elim_dist_mul = el.ElimDistMul()
-    self.elim_dist_add = el.ElimDistAdd()
-    self.elim_angle = el.ElimAngle()
-
-    self.point_subst = {x: x for x in points}
-    self.pair_to_line = dict()
-
-    # these three dictionaries are (AGPoint, AGPoint) -> LinComb
+    self.point_subst = PointUnion(points)
+    # dense index of the points, the pair tables are n x n arrays on it
+    self.point_index = {x: i for i, x in enumerate(self.points)}
+    # numeric precomputation of all the pairs at once: distances, lines,
+    # and the coincidence of the points, kept as nested lists for fast
+    # scalar access
+    coords = np.array([x.value for x in self.points], dtype=float)
+    dists, normals, offsets, directions = ng.pairwise_lines(coords)
+    self.coincident_rows = (dists < ng.ATOM).tolist()
+    self.distances = dists
+    # signed orientations of all the triples; the coordinates never change
+    # (merged points keep their own values), so this is never refreshed
+    self.orientations = ng.orientations(coords)
+    self.orientation_rows = self.orientations.tolist()
+    dists = dists.tolist()
+    directions = directions.tolist()
+    self.pair_to_line = PairTable(self.point_index)
+
+    # these three tables are (AGPoint, AGPoint) -> LinComb
     # but the LinComb is only representing a single ElimVar
-    # so in an efficient representation, they would be just 2D arrays of ints
-    self.pair_to_dist_mul = dict()
-    self.pair_to_dist_add = dict()
-    self.pair_to_dir = dict()
+    self.pair_to_dist_mul = PairTable(self.point_index)
+    self.pair_to_dist_add = PairTable(self.point_index)
+    self.pair_to_dir = PairTable(self.point_index)
+    # inverse maps, variable id -> pair, to follow the elimination changes
+    self.dist_mul_var_to_pair = dict()
+    self.dist_add_var_to_pair = dict()
+    self.dir_var_to_pair = dict()
 
-    for a, b in itertools.combinations(self.points, 2):
+    for (i, a), (j, b) in itertools.combinations(enumerate(self.points), 2):
 
-      if ng.distance(a.value, b.value) < ng.ATOM:
+      if self.coincident_rows[i][j]:
         continue
 
-      num_line = NumLine.through(a.value, b.value)
-      num_direction = num_line.direction()
-      direction = self.elim_angle.new_var(num_direction, f'd({a} {b})')
+      num_line = NumLine(normals[i, j], offsets[i, j])
+      direction = self.elim_angle.new_var(directions[i][j], f'd({a} {b})')
       line = FormalLine(
           points=[a, b],
           main_pair=(a, b),
@@ -102,46 +403,111 @@ class DDAR:
           value=num_line,
       )
       self.pair_to_dir[a, b] = direction
-      self.pair_to_dir[b, a] = direction
+      self.dir_var_to_pair[direction.comb.ids[0]] = a, b
       self.pair_to_line[a, b] = line
-      self.pair_to_line[b, a] = line
       self.lines.add(line)
+      self.point_to_lines[a].add(line)
+      self.point_to_lines[b].add(line)
 
-      dist = ng.distance(a.value, b.value)
+      dist = dists[i][j]
 
       dist_mul = self.elim_dist_mul.new_var(dist, f'log(|{a} {b}|)')
       self.pair_to_dist_mul[a, b] = dist_mul
-      self.pair_to_dist_mul[b, a] = dist_mul
+      self.dist_mul_var_to_pair[dist_mul.comb.ids[0]] = a, b
 
       dist_add = self.elim_dist_add.new_var(dist, f'|{a} {b}|')
       self.pair_to_dist_add[a, b] = dist_add
-      self.pair_to_dist_add[b, a] = dist_add
+      self.dist_add_var_to_pair[dist_add.comb.ids[0]] = a, b
 
+    # similar pairs of triangles, under the canonical key of similar_key;
+    # circles get introduced only once they are interesting, and are found
+    # through point_to_circles, see circle_through
     self.known_similar = set()
-    self.triple_to_circle = (
-        dict()
-    )  # circles get introduced only once they are interesting
     self.last_small_circles = []  # containing less than 3 points
-    self.dist_mul_cache = dict(self.pair_to_dist_mul)
-    self.direction_cache = dict(self.pair_to_dir)
+    self.dist_mul_cache = self.pair_to_dist_mul.copy()
+    self.direction_cache = self.pair_to_dir.copy()
+    # class ids of the cached values (see ElimCore.intern), for the rules
+    # grouping pairs by value to key and compare on ints
+    self.dist_mul_cache_ids = self.dist_mul_cache.copy()
+    self.direction_cache_ids = self.direction_cache.copy()
+    for elim, ids in (
+        (self.elim_dist_mul, self.dist_mul_cache_ids),
+        (self.elim_angle, self.direction_cache_ids),
+    ):
+      for row in ids.rows:
+        for j, x in enumerate(row):
+          if x is not None:
+            row[j] = elim.class_id(x)
+    # elimination versions the caches are up to date with
+    self.dist_mul_cache_version = 0
+    self.direction_cache_version = 0
+    self.undo_log = None  # only recorded after a checkpoint
+
+    # provenance: constraint id -> (rule, premises, predicate), the premises
+    # being the bitset of the (earlier) constraints the rule application
+    # relied on; the elimination rows carry bitsets of these ids
+    self.constraints = []
+
+    # persistent index of search_similar: signature -> triangles having it
+    # (as an ordered set), triangle -> its signatures, and the pairs not
+    # yet in any equation; it is rebuilt if `similar_versions` is None
+    self.similar_buckets = dict()
+    self.similar_keys = dict()
+    self.similar_unseen = set()
+    self.similar_points = set()
+    self.similar_versions = None
+    # common denominator of the direction constants in the signatures
+    self.similar_den = 1
+    # persistent index of search_concyclic: chord -> point -> its keys, and
+    # chord -> inscribed angle -> (points, centers) as ordered sets
+    self.chord_entries = dict()
+    self.chord_buckets = dict()
+    self.concyclic_points = set()
+    self.concyclic_versions = None
+    # search_circles: center -> its circles with less than 3 points
+    self.small_circles = dict()
+    self.circles_version = None
+    # classes of equal simplified pair quantities, built on the first query
+    # and refreshed from the elimination changes, see update_pair_classes
+    self.pair_classes = dict.fromkeys(PAIR_QUANTITIES)
+
+    # versions of the facts other than equations, see fact_versions
+    self.object_versions = dict(lines=0, circles=0, points=0)
+
+    # statistics of the last deduction closure, and of the running rule
+    self.stats = ClosureStats()
+    self.rule_stats = None
+    # limits of the running closure, see check_budget
+    self.budget = None
+    self.deadline = None
 
   def num_identical(self, a, b):
-    return (a, b) not in self.pair_to_dist_mul
+    return self.coincident_rows[self.point_index[a]][self.point_index[b]]
+
+  def orientation(self, a, b, c):
+    """Numerical orientation of the triangle abc: 1, -1, or 0 if collinear."""
+    index = self.point_index
+    return self.orientation_rows[index[a]][index[b]][index[c]]
 
   def force_pred(self, pred):
-    """Adds a predicate as an assumption."""
+    """Adds a predicate as an assumption, returns its constraint id."""
+    premises = self.merge_deps(pred.points)
     pred = pred.replace_points(self.point_subst)
+    if pred.name in ('cong', 'rconst', 'eqratio', 'cyclic_with_centers'):
+      # translated from the already simplified distances
+      premises |= self.pairs_deps(self.pred_pairs(pred), 'dist_mul')
+    deps = self.new_constraint('given', premises, pred)
 
     if pred.name == 'coll':
-      self.force_collinear(pred.points)
+      self.force_collinear(pred.points, deps)
     elif pred.name in ('angeq', 'para', 'perp', 's_angle', 'aconst', 'eqangle'):
-      self.elim_angle.force_zero(self.pred_to_angle(pred))
+      self.elim_angle.force_zero(self.pred_to_angle(pred), deps)
     elif pred.name in ('distmeq', 'cong', 'eqratio', 'rconst'):
-      self.elim_dist_mul.force_one(self.pred_to_dist_mul(pred))
+      self.elim_dist_mul.force_one(self.pred_to_dist_mul(pred), deps)
     elif pred.name == 'distseq':
-      self.elim_dist_add.force_zero(self.pred_to_dist_add(pred))
+      self.elim_dist_add.force_zero(self.pred_to_dist_add(pred), deps)
     elif pred.name == 'cyclic':
-      self.force_concyclic(pred.points, ())
+      self.force_concyclic(pred.points, (), deps)
     elif pred.name == 'cyclic_with_centers':
       [num_centers] = pred.constants
       centers = pred.points[:num_centers]
@@ -153,7 +519,7 @@ class DDAR:
           if len(distinct_points) == 3:
             break
       if len(distinct_points) >= 3:
-        self.force_concyclic(points, centers)
+        self.force_concyclic(points, centers, deps)
       else:
         a0 = points[0]
         c0 = centers[0]
@@ -161,15 +527,16 @@ class DDAR:
         for a in points:
           for c in centers:
             d = self.get_dist_mul(a, c)
-            self.elim_dist_mul.force_one(d0 / d)
+            self.elim_dist_mul.force_one(d0 / d, deps)
     elif pred.name == 'overlap':
       a, b = pred.points
-      self.force_equal_points(a, b)
+      self.force_equal_points(a, b, deps)
     elif pred.name == 'acompute':
       print("Warning: acompute predicate doesn't make sense to be forced")
       return
     else:
       raise ValueError('Unexpected predicate:', pred.name)
+    return len(self.constraints) - 1
 
   def pred_to_angle(self, pred):
     """Translate an angle predicate into an equation."""
@@ -265,17 +632,11 @@ class DDAR:
     if pred.name == 'coll':
       return self.check_collinear(pred.points)
     elif pred.name in ('angeq', 'para', 'perp', 's_angle', 'aconst', 'eqangle'):
-      res = self.pred_to_angle(pred)
-      res = self.elim_angle.simplify(res)
-      return res.is_zero()
+      return self.elim_angle.is_zero(self.pred_to_angle(pred))
     elif pred.name in ('distmeq', 'cong', 'eqratio', 'rconst'):
-      res = self.pred_to_dist_mul(pred)
-      res = self.elim_dist_mul.simplify(res)
-      return res.is_one()
+      return self.elim_dist_mul.is_one(self.pred_to_dist_mul(pred))
     elif pred.name == 'distseq':
-      res = self.pred_to_dist_add(pred)
-      res = self.elim_dist_add.simplify(res)
-      return res.is_zero()
+      return self.elim_dist_add.is_zero(self.pred_to_dist_add(pred))
     elif pred.name == 'cyclic':
       return self.check_concyclic(pred.points)
     elif pred.name == 'cyclic_with_centers':
@@ -290,226 +651,627 @@ class DDAR:
       a1, a2, b1, b2 = pred.points
       ang = self.pair_to_dir[a1, a2] - self.pair_to_dir[b1, b2]
       ang = self.elim_angle.simplify(ang)
-      if all(v == el.angle_unit for v in ang.comb.d.keys()):
-        return ang.comb.d.get(el.angle_unit, Fraction(0))
+      if all(v == el.angle_unit.id for v in ang.comb.ids):
+        return ang.comb.coef(el.angle_unit)
       else:
         return None
     else:
       raise ValueError('Unexpected predicate:', pred.name)
 
   ####### Loop
-  def deduction_closure(self, verbose=False, progress_dot=True):
-    """Infers all further facts deducible on the given point."""
-    # self.elim_dist_mul.core.display()
-    changed = True
-    while changed:
-      # for _ in range(5):
+  def deduction_closure(self, verbose=False, progress_dot=True, budget=None):
+    """Infers all further facts deducible on the given point.
+
+    A worklist in the style of semi-naive evaluation: every rule declares
+    the kinds of facts it consumes, and is only rerun once facts of one of
+    these kinds were produced since its previous run. The searches also
+    restrict themselves to the pairs / points whose facts changed.
+
+    Args:
+      verbose: print the progress of every rule.
+      progress_dot: print a dot per round (if not verbose).
+      budget: optional Budget, checked cooperatively inside the rules.
+
+    Returns:
+      FIXPOINT, or the name of the budget limit which cut the closure off.
+      In the latter case, the facts deduced so far remain queryable.
+    """
+    rules = (
+        (
+            'similar',
+            'Similar triangles...',
+            ('directions', 'ratios', 'points'),
+            lambda: self.search_similar(verbose=verbose),
+        ),
+        (
+            'concyclic',
+            'Cyclic quadrilaterals...',
+            ('directions', 'ratios', 'points'),
+            self.search_concyclic,
+        ),
+        ('circles', 'Circles...', ('ratios', 'points'), self.search_circles),
+        (
+            'merge_points',
+            'Merging points...',
+            ('lines', 'circles', 'points'),
+            self.merge_points,
+        ),
+        (
+            'dist_add_mul',
+            'Sync add / mul dist...',
+            ('ratios', 'distances', 'points'),
+            self.transfer_dist_add_mul,
+        ),
+        (
+            'dist_arc_mul',
+            'Sync segments / arcs...',
+            ('directions', 'ratios', 'circles'),
+            self.transfer_dist_arc_mul,
+        ),
+    )
+    self.stats = ClosureStats()
+    self.budget = budget
+    if budget is not None and budget.timeout is not None:
+      self.deadline = time.monotonic() + budget.timeout
+    try:
+      self.check_input_size()
+      self.stats.status = self.run_rules(rules, verbose, progress_dot)
+    except BudgetExceeded as e:
+      self.stats.status = e.status
+      # an interrupted search may have indexed without forcing
+      self.similar_versions = None
+      self.concyclic_versions = None
+      self.circles_version = None
+      self.update_cache()
+    finally:
+      self.budget = None
+      self.deadline = None
+      self.rule_stats = None
+    return self.stats.status
+
+  def run_rules(self, rules, verbose, progress_dot):
+    """The worklist loop of deduction_closure, returns its status."""
+    last_run = [None] * len(rules)  # fact versions seen by the last run
+
+    def due(i, versions):
+      """Whether facts rule i consumes were produced since its last run."""
+      return last_run[i] is None or any(
+          versions[kind] != last_run[i][kind] for kind in rules[i][2]
+      )
+
+    while True:
+      self.check_budget()
+      # a rule only becomes due by the run of another one: the fixpoint is
+      # reached once none is due at the start of a round
+      versions = self.fact_versions()
+      if not any(due(i, versions) for i in range(len(rules))):
+        return FIXPOINT
+      budget = self.budget
+      if budget is not None and budget.max_rounds is not None:
+        if len(self.stats.rounds) >= budget.max_rounds:
+          return MAX_ROUNDS
       if not verbose and progress_dot:
         print('.', flush=True, end='')
       self.update_cache()
-      changed = False
-
-      if verbose:
-        print('  Similar triangles...')
-      changed_last = self.search_similar(verbose=verbose)
-      changed = changed or changed_last
-      if changed_last:
-        self.update_cache()
-      if verbose:
-        print('  ... similar triangles      ', end='')
-        print(['----', 'Updated'][changed_last])
-
-      if verbose:
-        print('  Cyclic quadrilaterals...   ', end='')
-      changed_last = self.search_concyclic()
-      changed = changed or changed_last
-      if changed_last:
-        self.update_cache()
-      if verbose:
-        print(['----', 'Updated'][changed_last])
-
-      if verbose:
-        print('  Circles...                 ', end='')
-      changed_last = self.search_circles()
-      changed = changed or changed_last
-      if verbose:
-        print(['----', 'Updated'][changed_last])
-
-      if verbose:
-        print('  Merging points...          ', end='')
-      changed_last = self.merge_points()
-      changed = changed or changed_last
-      if verbose:
-        print(['----', 'Updated'][changed_last])
-
-      if verbose:
-        print('  Sync add / mul dist...     ', end='')
-      changed_last = self.transfer_dist_add_mul()
-      changed = changed or changed_last
-      if verbose:
-        print(['----', 'Updated'][changed_last])
-
-      if verbose:
-        print('  Sync segments / arcs...    ', end='')
-      changed_last = self.transfer_dist_arc_mul()
-      changed = changed or changed_last
-      if verbose:
-        print(['----', 'Updated'][changed_last])
-
-  def search_similar(self, verbose):
-    """Looks for similar triangles, and infers approproate facts."""
-    sss = dict()
-    aa = dict()
-    sas = dict()
-    ssa = dict()
-    ssa_triangles = set()
-    similar_pairs = []
-    count = 0
-    for a in self.points:
-      for b in self.points:
-        if self.num_identical(a, b):
+      self.stats.start_round()
+      for i, (key, name, consumes, rule) in enumerate(rules):
+        versions = self.fact_versions()
+        if not due(i, versions):
           continue
-        encountered = self.elim_angle.was_encountered(
-            self.pair_to_dir[a, b]
-        ) or self.elim_dist_mul.was_encountered(self.pair_to_dist_mul[a, b])
-        if not encountered:
-          continue
-        for c in self.points:
-          if self.num_identical(a, c):
-            continue
-          if self.num_identical(b, c):
-            continue
-          orient = ng.orientation(a.value, b.value, c.value)
-          if orient == 0:
-            continue
-          count += 1
-          rat1 = self.get_dist_ratio(a, b, a, c)
-          ang1 = self.get_point_angle(a, b, a, c)
-          rat2 = self.get_dist_ratio(c, b, c, a)
-          ang2 = self.get_point_angle(c, b, c, a)
-
-          if (rat1, rat2) in sss:
-            (a0, b0, c0), (_, _) = sss[rat1, rat2]
-            similar_pairs.append(((a0, b0, c0), (a, b, c)))
-          else:
-            sss[rat1, rat2] = (a, b, c), (rat1, rat2)
+        last_run[i] = versions
+        if verbose:
+          print(f'  {name:<27}', end='')
+        self.rule_stats = self.stats.start_rule(key)
+        start = time.perf_counter()
+        try:
+          changed_last = rule()
+          if changed_last:
+            self.update_cache()
+        finally:
+          self.rule_stats.time = time.perf_counter() - start
+          self.rule_stats = None
+        if verbose:
+          print(['----', 'Updated'][changed_last])
+
+  def check_budget(self):
+    """Raises BudgetExceeded if the running closure is over budget.
+
+    Rules call this at safe points only: between two inferences, where the
+    state is consistent.
+    """
+    budget = self.budget
+    if budget is None:
+      return
+    if self.deadline is not None and time.monotonic() > self.deadline:
+      raise BudgetExceeded(TIMEOUT)
+    for status, limit, size in (
+        (MAX_CONSTRAINTS, budget.max_constraints, len(self.constraints)),
+        (MAX_CIRCLES, budget.max_circles, len(self.circles)),
+    ):
+      if limit is not None and size > limit:
+        raise BudgetExceeded(status)
 
-          if (ang1, ang2) in aa:
-            (a0, b0, c0), (_, _) = aa[ang1, ang2]
-            similar_pairs.append(((a0, b0, c0), (a, b, c)))
-          else:
-            aa[ang1, ang2] = (a, b, c), (ang1, ang2)
-            aa[-ang1, -ang2] = (a, b, c), (-ang1, -ang2)
+  def check_input_size(self):
+    """Raises BudgetExceeded if the problem has too many points or lines.
 
-          if (ang1, rat1, orient) in sas:
-            (a0, b0, c0), (_, _) = sas[ang1, rat1, orient]
-            similar_pairs.append(((a0, b0, c0), (a, b, c)))
-          else:
-            sas[ang1, rat1, orient] = (a, b, c), (ang1, rat1)
-            sas[-ang1, rat1, -orient] = (a, b, c), (-ang1, rat1)
-
-          for a1, b1, c1, ang, rat, cur_orient in (
-              (a, b, c, ang1, rat2, orient),
-              (c, b, a, ang2, rat1, -orient),
-          ):
-            if (
-                ng.distance(c1.value, b1.value)
-                - ng.distance(c1.value, a1.value)
-                > ng.ATOM
-            ):
-              if (a1, b1, c1) in ssa_triangles:
-                continue
-              ssa_triangles.add((a1, b1, c1))
-              if (ang, rat, cur_orient) in ssa:
-                (a0, b0, c0), (_, _) = ssa[ang, rat, cur_orient]
-                similar_pairs.append(((a0, b0, c0), (a1, b1, c1)))
-              else:
-                ssa[ang, rat, cur_orient] = (a1, b1, c1), (ang, rat)
-                ssa[-ang, rat, -cur_orient] = (a1, b1, c1), (-ang, rat)
+    Both only decrease as points merge, so unlike the other limits they
+    are guards on the input, checked once before the closure starts.
+    """
+    budget = self.budget
+    if budget is None:
+      return
+    for status, limit, size in (
+        (MAX_POINTS, budget.max_points, len(self.points)),
+        (MAX_LINES, budget.max_lines, len(self.lines)),
+    ):
+      if limit is not None and size > limit:
+        raise BudgetExceeded(status)
+
+  def fact_versions(self):
+    """Counts of the produced facts, by kind."""
+    return dict(
+        directions=self.elim_angle.version,
+        ratios=self.elim_dist_mul.version,
+        distances=self.elim_dist_add.version,
+        **self.object_versions,
+    )
+
+  def produced(self, *kinds):
+    """Records that facts of the given kinds were produced."""
+    for kind in kinds:
+      self._set_item(self.object_versions, kind, self.object_versions[kind] + 1)
+
+  def search_similar(self, verbose):
+    """Looks for similar triangles, and infers approproate facts.
+
+    The triangle signatures are kept in a persistent index across rounds.
+    Only the triangles with a side whose simplified ratio or direction
+    changed since the previous search are signed again, and only their new
+    collisions are reported.
+    """
+    self.update_cache()
+    hashes = self.similar_hashes()
+    triangles = self.similar_dirty_triangles()
+    signatures = self.similar_signatures(triangles, *hashes)
+    similar_pairs = []
+    for triangle, signature in zip(triangles, signatures):
+      self.check_budget()
+      self.sign_triangle(triangle, signature, similar_pairs)
 
+    self.count(len(triangles), len(similar_pairs))
     if verbose:
-      print(f'    {count} triangles checked')
+      print(f'    {len(triangles)} triangles checked')
       print(f'    {len(similar_pairs)} similar pairs found')
 
     changed = False
-    for triangle1, triangle2 in similar_pairs:
-      changed = self.force_similar(triangle1, triangle2) or changed
+    for triangle1, triangle2, kind in similar_pairs:
+      self.check_budget()
+      if self.similar_key(triangle1, triangle2) in self.known_similar:
+        continue
+      exact_keys = self.similar_exact_keys(triangle1)[kind]
+      if self.similar_exact_keys(triangle2)[kind][0] not in exact_keys:
+        continue  # collision of the hashes only
+      changed = (
+          self.force_similar(triangle1, triangle2, SIMILAR_PREMISES[kind])
+          or changed
+      )
 
     return changed
 
-  def search_concyclic(self):
-    """Looks for cyclic quadrilaterals, and infers appropriate facts."""
-    changed = False
-    for a in self.points:
-      for b in self.points:
-        ang_to_points_centers = DefaultDict(lambda: ([], []))
-        on_line = []
-        for c in self.points:
-          if self.num_identical(a, c):
-            continue
-          if self.num_identical(b, c):
-            continue
+  def similar_hashes(self):
+    """Hash matrices of the cached ratios and directions, for the signatures.
+
+    The hashes of the simplified combinations are additive, so the hash of
+    a ratio or of an angle is a difference of two entries. The constant of
+    a direction is kept apart, as a multiple of 1 / similar_den, to be taken
+    modulo 1; the index is rebuilt if the denominator grows.
+    """
+    prime = el.FINGERPRINT_PRIME
+    unit = el.angle_unit
+    unit_key = el.zobrist_key(unit.id)
+    dist_hashes = [
+        [0 if x is None else x.comb.zhash for x in row]
+        for row in self.dist_mul_cache.rows
+    ]
+    dir_hashes = []
+    dir_consts = []
+    den = self.similar_den
+    for row in self.direction_cache.rows:
+      hashes = []
+      consts = []
+      for x in row:
+        if x is None:
+          hashes.append(0)
+          consts.append(0)
+          continue
+        const = x.comb.coef(unit)
+        hashes.append((x.comb.zhash - el.frac_mod(const) * unit_key) % prime)
+        consts.append(const)
+        den = math.lcm(den, const.denominator)
+      dir_hashes.append(hashes)
+      dir_consts.append(consts)
+    if den != self.similar_den:
+      self.similar_den = den
+      self.similar_versions = None
+    dir_consts = [[int(c * den) for c in row] for row in dir_consts]
+    return (
+        np.array(dist_hashes, dtype=np.int64),
+        np.array(dir_hashes, dtype=np.int64),
+        np.array(dir_consts, dtype=np.int64),
+    )
 
-          # 'c' on the circle
-          ang = self.get_point_angle(c, a, c, b)
+  def similar_signatures(self, triangles, dist_hashes, dir_hashes, dir_consts):
+    """Hashed ratios, angles and orientations of triangles, in one pass.
+
+    For a triangle (a, b, c), the entries are the ratios ac / ab and
+    ca / cb, the angles bac and bca (each as a hash and a constant),
+    the orientation, and whether the ssa signature applies.
+    """
+    if not triangles:
+      return []
+    prime = el.FINGERPRINT_PRIME
+    den = self.similar_den
+    index = self.point_index
+    ia, ib, ic = np.array(
+        [[index[x] for x in triangle] for triangle in triangles]
+    ).T
+    return list(
+        zip(
+            ((dist_hashes[ia, ic] - dist_hashes[ia, ib]) % prime).tolist(),
+            ((dist_hashes[ic, ia] - dist_hashes[ic, ib]) % prime).tolist(),
+            ((dir_hashes[ia, ic] - dir_hashes[ia, ib]) % prime).tolist(),
+            ((dir_consts[ia, ic] - dir_consts[ia, ib]) % den).tolist(),
+            ((dir_hashes[ic, ia] - dir_hashes[ic, ib]) % prime).tolist(),
+            ((dir_consts[ic, ia] - dir_consts[ic, ib]) % den).tolist(),
+            self.orientations[ia, ib, ic].tolist(),
+            (
+                self.distances[ic, ib] - self.distances[ic, ia] > ng.ATOM
+            ).tolist(),
+        )
+    )
 
-          if ang.is_zero():
-            on_line.append(c)
+  def similar_exact_keys(self, triangle):
+    """Signatures of a triangle as exact values, kind -> [key, mirrored].
+
+    Confirms the collisions of the hashed signatures of sign_triangle. The
+    ratios and angles are given by their class ids, see ElimCore.intern.
+    """
+    a, b, c = triangle
+    ratio_id = self.elim_dist_mul.class_id
+    angle_id = self.elim_angle.class_id
+    rat1 = ratio_id(self.get_dist_ratio(a, b, a, c))
+    rat2 = ratio_id(self.get_dist_ratio(c, b, c, a))
+    ang1 = self.get_point_angle(a, b, a, c)
+    ang2 = self.get_point_angle(c, b, c, a)
+    ang1, neg1 = angle_id(ang1), angle_id(-ang1)
+    ang2, neg2 = angle_id(ang2), angle_id(-ang2)
+    orient = self.orientation(a, b, c)
+    return dict(
+        sss=[(rat1, rat2)],
+        aa=[(ang1, ang2), (neg1, neg2)],
+        sas=[(ang1, rat1, orient), (neg1, rat1, -orient)],
+        ssa=[(ang1, rat2, orient), (neg1, rat2, -orient)],
+    )
 
-          if self.num_identical(a, b):
-            continue
+  def similar_dirty_triangles(self):
+    """Triangles whose signatures may have changed since the last search."""
+    versions = self.elim_dist_mul.version, self.elim_angle.version
+    points = self.points
+    if self.similar_versions is None:  # (re)build the index
+      self.similar_buckets = dict()
+      self.similar_keys = dict()
+      self.similar_unseen = {
+          (a, b)
+          for a in points
+          for b in points
+          if not self.num_identical(a, b)
+          and not self.pair_encountered(a, b)
+      }
+      self.similar_points = set(points)
+      self.similar_versions = versions
+      unseen = self.similar_unseen
+      return [
+          (a, b, c)
+          for a in points
+          for b in points
+          if not self.num_identical(a, b)
+          for c in points
+          if not self.num_identical(a, c) and not self.num_identical(b, c)
+          if (a, b) not in unseen or (c, b) not in unseen
+      ]
+
+    pairs = self.changed_pairs(*self.similar_versions)
+    seen = {
+        (a, b) for a, b in self.similar_unseen if self.pair_encountered(a, b)
+    }
+    self.similar_unseen -= seen
+    pairs |= seen
+    self.similar_versions = versions
+
+    triangles = set()
+    removed = self.similar_points - set(points)
+    if removed:
+      self.similar_points = set(points)
+      triangles.update(
+          t for t in self.similar_keys if not removed.isdisjoint(t)
+      )
+    for a, b in pairs:
+      if a not in self.similar_points or b not in self.similar_points:
+        continue
+      for c in points:
+        if self.num_identical(a, c) or self.num_identical(b, c):
+          continue
+        triangles.update(itertools.permutations((a, b, c)))
+    index = {x: i for i, x in enumerate(self.points)}
+    return sorted(
+        triangles, key=lambda t: tuple(index.get(x, -1) for x in t)
+    )
 
-          if not ng.collinear(a.value, b.value, c.value):
-            points, _ = ang_to_points_centers[ang]
-            points.append(c)
+  def changed_pairs(self, dist_mul_version, angle_version):
+    """Pairs whose simplified ratio or direction changed since the versions."""
+    pairs = set()
+    for var in self.elim_dist_mul.changed_since(dist_mul_version):
+      pairs.add(self.dist_mul_var_to_pair[var])
+    for var in self.elim_angle.changed_since(angle_version):
+      pairs.add(self.dir_var_to_pair[var])
+    return pairs
+
+  def pair_encountered(self, a, b):
+    return self.elim_angle.was_encountered(
+        self.pair_to_dir[a, b]
+    ) or self.elim_dist_mul.was_encountered(self.pair_to_dist_mul[a, b])
+
+  def sign_triangle(self, triangle, signature, similar_pairs):
+    """Re-indexes a triangle, collecting the pairs it newly collides with.
+
+    Signatures of a triangle (a, b, c) are the sss / aa / sas keys if its
+    side (a, b) takes part in some equation, and the ssa key if that side or
+    (c, b) does. The keys are built from the hashes of similar_signatures,
+    the collisions are (triangle, triangle, kind of the key).
+    """
+    buckets = self.similar_buckets
+    for key in self.similar_keys.pop(triangle, ()):
+      bucket = buckets[key]
+      del bucket[triangle]
+      if not bucket:
+        del buckets[key]
+
+    a, b, c = triangle
+    if not self.similar_points.issuperset(triangle):
+      return
+    unseen = self.similar_unseen
+    encountered = (a, b) not in unseen
+    if not encountered and (c, b) in unseen:
+      return
 
-          dist_ratio = self.get_dist_ratio(c, a, c, b)
-          if dist_ratio.is_one():  # 'c' as a center
-            halfang = self.get_point_angle(a, c, a, b) + self.elim_angle.const(
-                1, 2
-            )
-            _, centers = ang_to_points_centers[halfang]
-            centers.append(c)
+    rat1, rat2, ang1, const1, ang2, const2, orient, ssa = signature
+    if orient == 0:
+      return
+    prime = el.FINGERPRINT_PRIME
+    den = self.similar_den
+    neg1 = -ang1 % prime, -const1 % den
+    lookups = []
+    keys = []
+    if encountered:
+      lookups += [
+          ('sss', rat1, rat2),
+          ('aa', ang1, const1, ang2, const2),
+          ('sas', ang1, const1, rat1, orient),
+      ]
+      keys += [
+          ('aa', *neg1, -ang2 % prime, -const2 % den),
+          ('sas', *neg1, rat1, -orient),
+      ]
+    if ssa:
+      lookups.append(('ssa', ang1, const1, rat2, orient))
+      keys.append(('ssa', *neg1, rat2, -orient))
+
+    for key in lookups:
+      bucket = buckets.get(key)
+      if bucket:
+        similar_pairs.append((next(iter(bucket)), triangle, key[0]))
+    keys += lookups
+    for key in keys:
+      buckets.setdefault(key, dict())[triangle] = None
+    self.similar_keys[triangle] = keys
 
-        for c in on_line:
-          changed = self.force_collinear([a, b, c]) or changed
+  def search_concyclic(self):
+    """Looks for cyclic quadrilaterals, and infers appropriate facts.
+
+    For every chord (a, b), the points c are indexed by the inscribed angle
+    acb, and the centers c by the corresponding half angle. The index
+    persists across rounds: only the entries on pairs whose direction or
+    ratio moved are recomputed, and only the groups they joined are forced.
+    """
+    self.update_cache()
+    collinear = []
+    groups = set()
+    entries = self.concyclic_dirty_entries()
+    self.count(candidates=len(entries))
+    for a, b, c in entries:
+      self.check_budget()
+      on_line = self.index_chord_entry(a, b, c)
+      if on_line:
+        collinear.append((a, b, c))
+      for key in self.chord_entries[a, b].get(c, ()):
+        groups.add((a, b, key))
+
+    index = {x: i for i, x in enumerate(self.points)}
+    changed = False
+    self.count(collisions=len(collinear))
+    for a, b, c in collinear:
+      self.check_budget()
+      deps = self.new_constraint(
+          'concyclic', self.pairs_deps([(c, a), (c, b)], 'direction')
+      )
+      changed_now = self.force_collinear([a, b, c], deps)
+      self.release_constraint(deps, changed_now)
+      changed = changed_now or changed
 
-        for points, centers in ang_to_points_centers.values():
-          if len(points) >= 2 or (centers and points):
-            changed = self.force_concyclic([a, b] + points, centers) or changed
+    for a, b, key in sorted(
+        groups, key=lambda g: (index[g[0]], index[g[1]])
+    ):
+      self.check_budget()
+      points, centers = self.chord_buckets[a, b].get(key, ((), ()))
+      if len(points) >= 2 or (centers and points):
+        self.count(collisions=1)
+        points = sorted(points, key=index.get)
+        centers = sorted(centers, key=index.get)
+        pairs = [(a, b)]
+        pairs.extend((c, x) for c in points + centers for x in (a, b))
+        deps = self.new_constraint(
+            'concyclic', self.pairs_deps(pairs, 'direction', 'dist_mul')
+        )
+        changed_now = self.force_concyclic([a, b] + points, centers, deps)
+        self.release_constraint(deps, changed_now)
+        changed = changed_now or changed
 
     return changed
 
+  def concyclic_dirty_entries(self):
+    """Chord entries (a, b, c) that may have changed since the last search."""
+    versions = self.elim_dist_mul.version, self.elim_angle.version
+    points = self.points
+    if self.concyclic_versions is None:  # (re)build the index
+      self.chord_entries = {(a, b): dict() for a in points for b in points}
+      self.chord_buckets = {(a, b): dict() for a in points for b in points}
+      self.concyclic_points = set(points)
+      self.concyclic_versions = versions
+      return [
+          (a, b, c)
+          for a in points
+          for b in points
+          if a != b
+          for c in points
+          if not self.num_identical(a, c) and not self.num_identical(b, c)
+      ]
+
+    entries = set()
+    removed = self.concyclic_points - set(points)
+    if removed:
+      self.concyclic_points = set(points)
+      for (a, b), chord in list(self.chord_entries.items()):
+        if a in removed or b in removed:
+          del self.chord_entries[a, b]
+          del self.chord_buckets[a, b]
+          continue
+        entries.update((a, b, c) for c in chord if c in removed)
+
+    for p, q in self.changed_pairs(*self.concyclic_versions):
+      if p not in self.concyclic_points or q not in self.concyclic_points:
+        continue
+      for x in points:
+        for c, a in ((p, q), (q, p)):
+          # the pair is (c, a) or (c, b), or the chord itself
+          if x != a and not self.num_identical(x, c):
+            entries.add((a, x, c))
+            entries.add((x, a, c))
+          if not self.num_identical(x, p) and not self.num_identical(x, q):
+            entries.add((a, c, x))
+    self.concyclic_versions = versions
+
+    index = {x: i for i, x in enumerate(points)}
+    return sorted(entries, key=lambda e: tuple(index.get(x, -1) for x in e))
+
+  def index_chord_entry(self, a, b, c):
+    """Re-indexes c for the chord (a, b), returns whether acb is flat."""
+    entries = self.chord_entries[a, b]
+    buckets = self.chord_buckets[a, b]
+    for key in entries.pop(c, ()):
+      points, centers = buckets[key]
+      points.pop(c, None)
+      centers.pop(c, None)
+      if not points and not centers:
+        del buckets[key]
+    if c not in self.concyclic_points:
+      return False
+
+    # 'c' on the circle
+    index = self.point_index
+    ia, ib, ic = index[a], index[b], index[c]
+    dir_c = self.direction_cache.rows[ic]
+    ang = dir_c[ib] - dir_c[ia]
+    on_line = ang.is_zero()
+    if self.num_identical(a, b):
+      return on_line
+
+    # the buckets are keyed on the class ids of the angles
+    keys = []
+    if self.orientation_rows[ia][ib][ic]:
+      key = self.elim_angle.class_id(ang)
+      points, _ = buckets.setdefault(key, (dict(), dict()))
+      points[c] = None
+      keys.append(key)
+
+    dist_c = self.dist_mul_cache_ids.rows[ic]
+    if dist_c[ib] == dist_c[ia]:  # 'c' as a center
+      dir_a = self.direction_cache.rows[ia]
+      halfang = dir_a[ib] - dir_a[ic] + self.elim_angle.const(1, 2)
+      key = self.elim_angle.class_id(halfang)
+      _, centers = buckets.setdefault(key, (dict(), dict()))
+      centers[c] = None
+      keys.append(key)
+    entries[c] = keys
+    return on_line
+
   def search_circles(self):
-    """Looks for equal distances implying a circle."""
-    changed = False
-    self.last_small_circles = []
+    """Looks for equal distances implying a circle.
 
-    for a in self.points:
+    Only the centers with a distance changed since the previous search are
+    revisited, the small circles of the others are kept.
+    """
+    changed = False
+    points_set = set(self.points)
+    if self.circles_version is None:  # (re)build
+      self.small_circles = dict()
+      centers = self.points
+    else:
+      removed = [a for a in self.small_circles if a not in points_set]
+      centers = set()
+      for a in removed:
+        del self.small_circles[a]
+      for a, circles in self.small_circles.items():
+        if any(not points_set.issuperset(c.points) for c in circles):
+          centers.add(a)
+      for a, b in self.changed_pairs(
+          self.circles_version, self.elim_angle.version
+      ):
+        centers.update((a, b))
+      centers = [a for a in self.points if a in centers]
+    self.circles_version = self.elim_dist_mul.version
+    self.count(candidates=len(centers))
+
+    for a in centers:
+      self.check_budget()
+      small_circles = []
+      # grouped by the class ids of the distances, all taken before any
+      # circle of this center is forced (which changes the basis)
       dist_to_points = dict()
       for b in self.points:
         if self.num_identical(a, b):
           continue
-        dist = self.get_dist_mul(a, b)
-        if dist not in dist_to_points:
-          dist_to_points[dist] = [(b, dist)]
-        else:
-          dist_to_points[dist].append((b, dist))
+        dist_to_points.setdefault(self.get_dist_mul_id(a, b), []).append(b)
 
-      for _, points in dist_to_points.items():
-        if len(points) <= 1:
+      for points_only in dist_to_points.values():
+        if len(points_only) <= 1:
           continue
+        self.count(collisions=1)
         distinct_points = []
-        for point, _ in points:
+        for point in points_only:
           if any(self.num_identical(point, x) for x in distinct_points):
             continue
           distinct_points.append(point)
-        points_only = [point for point, _ in points]
 
+        premises = self.pairs_deps(
+            ((a, point) for point in points_only), 'dist_mul'
+        )
         if len(distinct_points) >= 3:
-          changed = self.force_concyclic(points_only, (a,)) or changed
+          deps = self.new_constraint('circle', premises)
+          changed_now = self.force_concyclic(points_only, (a,), deps)
+          self.release_constraint(deps, changed_now)
+          changed = changed_now or changed
         else:
-          self.last_small_circles.append(
+          small_circles.append(
               FormalCircle(
                   defining_points=None,
                   points=points_only,
@@ -518,9 +1280,17 @@ class DDAR:
                       center=a.value,
                       r=ng.distance(a.value, points_only[0].value),
                   ),
+                  deps=premises,
               )
           )
+      if small_circles or self.small_circles.get(a):
+        self.produced('circles')
+      self.small_circles[a] = small_circles
 
+    self._set_attr(
+        'last_small_circles',
+        [c for a in self.points for c in self.small_circles.get(a, ())],
+    )
     return changed
 
   def merge_points(self):
@@ -535,27 +1305,39 @@ class DDAR:
     }
     if not same_pairs:
       return False
+    self.count(candidates=len(same_pairs))
 
-    for obj in itertools.chain(
-        self.lines, self.last_small_circles, self.circles
-    ):
+    point_to_lines = self.point_to_lines
+    point_to_circles = self.point_to_circles
+    for (a, b), objs in same_pairs.items():
+      objs.extend(point_to_lines[a] & point_to_lines[b])
+    for obj in self.last_small_circles:
       for a in obj.points:
         for b in obj.points:
           l = same_pairs.get((a, b))
           if l is None:
             continue
           l.append(obj)
+    for (a, b), objs in same_pairs.items():
+      objs.extend(
+          circle
+          for circle in point_to_circles[a] & point_to_circles[b]
+          if a in circle.points and b in circle.points
+      )
 
     # merge multiple centers of the same circle
     for circle in list(self.circles):
       if len(circle.centers) > 1:
+        self.count(collisions=len(circle.centers) - 1)
         for center in circle.centers[1:]:
-          self.force_equal_points(circle.centers[0], center)
+          deps = self.new_constraint('merge', circle.deps)
+          self.force_equal_points(circle.centers[0], center, deps)
 
     # if two such objects for a single pair are not tangent, merge them
     for (a, b), objs in same_pairs.items():
       if len(objs) <= 1:
         continue
+      self.check_budget()
       intersection_dirs = []
       for obj in objs:
         if isinstance(obj, FormalCircle):
@@ -569,7 +1351,11 @@ class DDAR:
       d0 = intersection_dirs[0]
       for d1 in intersection_dirs[1:]:
         if abs((d0 - d1 + 0.5) % 1 - 0.5) ** 2 >= ng.ATOM:
-          self.force_equal_points(a, b)
+          self.count(collisions=1)
+          premises = 0
+          for obj in objs:
+            premises |= obj.deps
+          self.force_equal_points(a, b, self.new_constraint('merge', premises))
           changed = (
               True  # we were not searching through previously merged points
           )
@@ -590,6 +1376,8 @@ class DDAR:
     for a, b in itertools.combinations(self.points, 2):
       if self.num_identical(a, b):
         continue
+      self.check_budget()
+      self.count(candidates=1)
       mul = self.get_dist_mul(a, b)
       add = self.get_dist_add(a, b)
       mul_n, mul_coef = mul.normalize()
@@ -606,16 +1394,30 @@ class DDAR:
           mul_n.value,
           add1.value,
       )
+      # each direction reads one system and writes the other, the equation
+      # written goes in the unsimplified variables of the target system
+      add1 = self.pair_to_dist_add[a, b] / mul_coef
+      mul1 = self.pair_to_dist_mul[a, b] / add_coef
+      mul_deps = self.pairs_deps([(a, b)], 'dist_mul')
+      add_deps = self.pairs_deps([(a, b)], 'dist_add')
       if mul_n in mul_to_add:
-        add2 = mul_to_add[mul_n]
-        changed = self.elim_dist_add.force_zero(add2 - add1) or changed
+        self.count(collisions=1)
+        add2, deps2 = mul_to_add[mul_n]
+        deps = self.new_constraint('dist_add_mul', mul_deps | deps2)
+        changed_now = self.elim_dist_add.force_zero(add2 - add1, deps)
+        self.release_constraint(deps, changed_now)
+        changed = changed_now or changed
       else:
-        mul_to_add[mul_n] = add1
+        mul_to_add[mul_n] = add1, mul_deps
       if add_n in add_to_mul:
-        mul2 = add_to_mul[add_n]
-        changed = self.elim_dist_mul.force_one(mul2 / mul1) or changed
+        self.count(collisions=1)
+        mul2, deps2 = add_to_mul[add_n]
+        deps = self.new_constraint('dist_add_mul', add_deps | deps2)
+        changed_now = self.elim_dist_mul.force_one(mul2 / mul1, deps)
+        self.release_constraint(deps, changed_now)
+        changed = changed_now or changed
       else:
-        add_to_mul[add_n] = mul1
+        add_to_mul[add_n] = mul1, add_deps
 
     return changed
 
@@ -631,55 +1433,75 @@ class DDAR:
         for b in circle.points:
           if ng.orientation(a.value, b.value, circle.value.center) != 1:
             continue
-          arc, _ = self.get_arc(circle, a, b)
+          self.check_budget()
+          self.count(candidates=1)
+          arc, c = self.get_arc(circle, a, b)
           arc_val = self.elim_angle.simplify(arc)
           dist = self.pair_to_dist_mul[a, b]
           dist_val = self.elim_dist_mul.simplify(dist)
+          src_deps = circle.deps | self.pairs_deps(
+              [(a, b), (a, c), (b, c)], 'direction', 'dist_mul'
+          )
           if arc_val in arc_to_src:
-            dist2 = arc_to_src[arc_val]
-            changed = self.elim_dist_mul.force_one(dist / dist2) or changed
+            self.count(collisions=1)
+            dist2, deps2 = arc_to_src[arc_val]
+            deps = self.new_constraint('dist_arc_mul', src_deps | deps2)
+            changed_now = self.elim_dist_mul.force_one(dist / dist2, deps)
+            self.release_constraint(deps, changed_now)
+            changed = changed_now or changed
           else:
-            arc_to_src[arc] = dist
+            arc_to_src[arc] = dist, src_deps
           if dist_val in dist_to_src:
-            arc2 = dist_to_src[dist_val]
-            changed = self.elim_angle.force_zero(arc - arc2) or changed
+            self.count(collisions=1)
+            arc2, deps2 = dist_to_src[dist_val]
+            deps = self.new_constraint('dist_arc_mul', src_deps | deps2)
+            changed_now = self.elim_angle.force_zero(arc - arc2, deps)
+            self.release_constraint(deps, changed_now)
+            changed = changed_now or changed
           else:
-            dist_to_src[dist] = arc
+            dist_to_src[dist] = arc, src_deps
 
     return changed
 
-  def force_similar(self, triangle1, triangle2):
-    """Adds a fact that the two triangles are similar."""
-    if (triangle1, triangle2) in self.known_similar:
+  def similar_key(self, triangle1, triangle2):
+    """Key of a similarity, independent of the order of the vertex pairs.
+
+    The correspondence is a set of three pairs of point indexes; swapping
+    the triangles flips every pair, and the smaller of the two sorted forms
+    is the canonical one.
+    """
+    index = self.point_index
+    pairs = [(index[p], index[q]) for p, q in zip(triangle1, triangle2)]
+    swapped = [(q, p) for p, q in pairs]
+    return min(tuple(sorted(pairs)), tuple(sorted(swapped)))
+
+  def force_similar(
+      self, triangle1, triangle2, premises=('direction', 'dist_mul')
+  ):
+    """Adds a fact that the two triangles are similar.
+
+    `premises` are the kinds of pair quantities the similarity was found
+    from, see SIMILAR_PREMISES; only their constraints are its premises.
+    """
+    key = self.similar_key(triangle1, triangle2)
+    if key in self.known_similar:
       return False
+    self._set_add(self.known_similar, key)
     a, b, c = triangle1
     x, y, z = triangle2
-    self.known_similar.add(((a, b, c), (x, y, z)))
-    self.known_similar.add(((a, c, b), (x, z, y)))
-    self.known_similar.add(((b, a, c), (y, x, z)))
-    self.known_similar.add(((c, a, b), (z, x, y)))
-    self.known_similar.add(((b, c, a), (y, z, x)))
-    self.known_similar.add(((c, b, a), (z, y, x)))
-
-    self.known_similar.add(((x, y, z), (a, b, c)))
-    self.known_similar.add(((x, z, y), (a, c, b)))
-    self.known_similar.add(((y, x, z), (b, a, c)))
-    self.known_similar.add(((z, x, y), (c, a, b)))
-    self.known_similar.add(((y, z, x), (b, c, a)))
-    self.known_similar.add(((z, y, x), (c, b, a)))
 
     # print("Similar:", a,b,c, ", ", x,y,z)
-    t1_rat1 = self.get_dist_ratio(a, b, a, c)
-    t1_ang1 = self.get_point_angle(a, b, a, c)
-    t1_rat2 = self.get_dist_ratio(a, b, b, c)
-    t1_ang2 = self.get_point_angle(a, b, b, c)
-    t2_rat1 = self.get_dist_ratio(x, y, x, z)
-    t2_ang1 = self.get_point_angle(x, y, x, z)
-    t2_rat2 = self.get_dist_ratio(x, y, y, z)
-    t2_ang2 = self.get_point_angle(x, y, y, z)
-    if ng.orientation(a.value, b.value, c.value) != ng.orientation(
-        x.value, y.value, z.value
-    ):
+    # in the unsimplified variables: the rows the elimination substitutes
+    # bring their own deps, the premises are only what found the similarity
+    t1_rat1 = self.pair_dist_ratio(a, b, a, c)
+    t1_ang1 = self.pair_angle(a, b, a, c)
+    t1_rat2 = self.pair_dist_ratio(a, b, b, c)
+    t1_ang2 = self.pair_angle(a, b, b, c)
+    t2_rat1 = self.pair_dist_ratio(x, y, x, z)
+    t2_ang1 = self.pair_angle(x, y, x, z)
+    t2_rat2 = self.pair_dist_ratio(x, y, y, z)
+    t2_ang2 = self.pair_angle(x, y, y, z)
+    if self.orientation(a, b, c) != self.orientation(x, y, z):
       # opposite orientation
       t2_ang1 = -t2_ang1
       t2_ang2 = -t2_ang2
@@ -687,17 +1509,32 @@ class DDAR:
       # same orientation
       pass
 
+    deps = self.new_constraint(
+        'similar',
+        self.pairs_deps(
+            [(a, b), (a, c), (b, c), (x, y), (x, z), (y, z)], *premises
+        ),
+    )
     changed = False
-    changed = self.elim_angle.force_zero(t1_ang1 - t2_ang1) or changed
-    changed = self.elim_angle.force_zero(t1_ang2 - t2_ang2) or changed
-    changed = self.elim_dist_mul.force_one(t1_rat1 / t2_rat1) or changed
-    changed = self.elim_dist_mul.force_one(t1_rat2 / t2_rat2) or changed
+    changed = (
+        self.elim_angle.force_zeros(
+            [t1_ang1 - t2_ang1, t1_ang2 - t2_ang2], deps
+        )
+        or changed
+    )
+    changed = (
+        self.elim_dist_mul.force_ones(
+            [t1_rat1 / t2_rat1, t1_rat2 / t2_rat2], deps
+        )
+        or changed
+    )
+    self.release_constraint(deps, changed)
 
     return changed
 
   ########### Collinearity / concyclicity
 
-  def force_collinear(self, points):
+  def force_collinear(self, points, deps=0):
     """Adds a fact that the given points are collinear."""
     assert len(points) > 1
     a = points[0]
@@ -740,6 +1577,8 @@ class DDAR:
 
     # sort points
     points = sorted(points, key=lambda point: line1.value.position(point.value))
+    for line in lines:
+      deps |= line.deps
 
     # order the points
     main_line = FormalLine(
@@ -747,11 +1586,13 @@ class DDAR:
         main_pair=line1.main_pair,
         direction=line1.direction,
         value=line1.value,
+        deps=deps,
     )
 
     # additive segments on the line
     a = points[0]
     a1 = points[-1]
+    segments = []
     for b, c in itertools.combinations(points[1:], 2):
       if self.num_identical(b, c):
         continue
@@ -763,26 +1604,27 @@ class DDAR:
         pos_c = self.pair_to_dist_add[a, a1] - self.pair_to_dist_add[a1, c]
       else:
         pos_c = self.pair_to_dist_add[a, c]
-      self.elim_dist_add.force_zero(
-          pos_b + self.pair_to_dist_add[b, c] - pos_c,
-      )
+      segments.append(pos_b + self.pair_to_dist_add[b, c] - pos_c)
+    self.elim_dist_add.force_zeros(segments, deps)
 
     a, b = main_line.main_pair
     # glue the directions of the other lines
-    for line in lines:
-      self.elim_angle.force_zero(main_line.direction - line.direction)
+    self.elim_angle.force_zeros(
+        [main_line.direction - line.direction for line in lines], deps
+    )
 
     # replace the old lines with the new one
-    self.lines.difference_update(lines)
-    self.lines.add(main_line)
+    for line in lines:
+      self.remove_line(line)
+    self.add_line(main_line)
     for x, y in itertools.combinations(main_line.points, 2):
       if not self.num_identical(x, y):
-        self.pair_to_line[x, y] = main_line
-        self.pair_to_line[y, x] = main_line
+        self._set_item(self.pair_to_line, (x, y), main_line)
+    self.produced('lines')
 
     return True
 
-  def force_concyclic(self, points, centers):
+  def force_concyclic(self, points, centers, deps=0):
     """Adds a fact that the points are concyclic (with optional center)."""
 
     # find all merged circles / points on them
@@ -802,7 +1644,7 @@ class DDAR:
           continue
         if self.num_identical(b, c):
           continue
-        circle = self.triple_to_circle.get((a, b, c))
+        circle = self.circle_through(a, b, c)
         if circle is None or circle in circles_set:
           continue
         if not circles:
@@ -853,6 +1695,7 @@ class DDAR:
     centers = set(centers)
     for circle in circles:
       centers.update(circle.centers)
+      deps |= circle.deps
     centers = sorted(centers, key=lambda x: x.name)
 
     main_circle = FormalCircle(
@@ -860,10 +1703,12 @@ class DDAR:
         points=points,
         centers=centers,
         value=circle_value,
+        deps=deps,
     )
 
     # implied angle equalities
     a, b, c = defining_points
+    inscribed = []
     for x, y in itertools.combinations(points, 2):
       if self.num_identical(x, y):
         continue
@@ -877,32 +1722,58 @@ class DDAR:
         y2 = c
       ang = self.pair_to_dir[x, y2] - self.pair_to_dir[x, y]
       arc, _ = self.get_arc(main_circle, y, y2)
-      self.elim_angle.force_zero(ang - arc)
+      inscribed.append(ang - arc)
+    self.elim_angle.force_zeros(inscribed, deps)
 
     # equal distance from the center
     if centers:
-      radius = self.get_dist_mul(points[0], centers[0])
+      radius = self.pair_to_dist_mul[points[0], centers[0]]
       center = centers[0]
-      for x in points[1:]:
-        dist = self.get_dist_mul(x, center)
-        self.elim_dist_mul.force_one(radius / dist)
+      self.elim_dist_mul.force_ones(
+          [radius / self.pair_to_dist_mul[x, center] for x in points[1:]],
+          deps,
+      )
 
     # Exchange circle in the database
-    self.circles.difference_update(circles)
-    self.circles.add(main_circle)
-    for a in points:
-      for b in points:
-        if self.num_identical(a, b):
-          continue
-        for c in points:
-          if self.num_identical(a, c):
-            continue
-          if self.num_identical(b, c):
-            continue
-          self.triple_to_circle[a, b, c] = main_circle
+    for circle in circles:
+      self.remove_circle(circle)
+    self.add_circle(main_circle)
+    self.produced('circles')
 
     return True
 
+  def add_line(self, line):
+    """Adds a line to the database and to the incidence index."""
+    self._set_add(self.lines, line)
+    for x in line.points:
+      self._set_add(self.point_to_lines[x], line)
+
+  def remove_line(self, line):
+    self._set_discard(self.lines, line)
+    for x in line.points:
+      self._set_discard(self.point_to_lines[x], line)
+
+  def add_circle(self, circle):
+    """Adds a circle to the database and to the incidence index."""
+    self._set_add(self.circles, circle)
+    for x in itertools.chain(circle.points, circle.centers):
+      self._set_add(self.point_to_circles[x], circle)
+
+  def remove_circle(self, circle):
+    self._set_discard(self.circles, circle)
+    for x in itertools.chain(circle.points, circle.centers):
+      self._set_discard(self.point_to_circles[x], circle)
+
+  def circle_through(self, a, b, c):
+    """The known circle through three numerically distinct points, or None.
+
+    Circles sharing three distinct points get merged, so there is at most one.
+    """
+    for circle in self.point_to_circles[a]:
+      if a in circle.points and b in circle.points and c in circle.points:
+        return circle
+    return None
+
   def check_collinear(self, points):
     for a, b in itertools.combinations(points, 2):
       line = self.pair_to_line.get((a, b))
@@ -921,7 +1792,7 @@ class DDAR:
     if len(distinct_points) < 3:
       raise ValueError('Need at least three numerically distinct points')
 
-    circle = self.triple_to_circle.get(tuple(distinct_points[:3]))
+    circle = self.circle_through(*distinct_points[:3])
 
     if circle is None:
       return False
@@ -934,15 +1805,16 @@ class DDAR:
 
   ############# Point merging
 
-  def force_equal_points(self, a, b):
+  def force_equal_points(self, a, b, deps=0):
     """Merges two given points (they are provably equal)."""
+    deps |= self.merge_deps([a, b])
     a = self.point_subst[a]
     b = self.point_subst[b]
     if a == b:
       return False
 
-    # merge in lines
-    for line in list(self.lines):
+    # merge in lines, only the ones through a or b are affected
+    for line in list(self.point_to_lines[a] | self.point_to_lines[b]):
       has_a = a in line.points
       has_b = b in line.points
       if has_a == has_b:
@@ -952,9 +1824,9 @@ class DDAR:
         points.append(a)
       else:
         points.append(b)
-      self.force_collinear(points)
+      self.force_collinear(points, deps | line.deps)
 
-    for line in list(self.lines):
+    for line in list(self.point_to_lines[b]):
       if b in line.points:
         main_pair = line.main_pair
         direction = line.direction
@@ -968,15 +1840,16 @@ class DDAR:
             main_pair=main_pair,
             direction=direction,
             value=line.value,
+            deps=deps | line.deps,
         )
-        for x, y in itertools.permutations(line2.points, 2):
+        for x, y in itertools.combinations(line2.points, 2):
           if not self.num_identical(x, y):
-            self.pair_to_line[x, y] = line2
-        self.lines.remove(line)
-        self.lines.add(line2)
+            self._set_item(self.pair_to_line, (x, y), line2)
+        self.remove_line(line)
+        self.add_line(line2)
 
     # merge in circles
-    for circle in list(self.circles):
+    for circle in list(self.point_to_circles[a] | self.point_to_circles[b]):
       has_a = a in circle.points
       has_b = b in circle.points
       if has_a == has_b:
@@ -986,8 +1859,8 @@ class DDAR:
         points.append(a)
       else:
         points.append(b)
-      self.force_concyclic(points, circle.centers)
-    for circle in list(self.circles):
+      self.force_concyclic(points, circle.centers, deps | circle.deps)
+    for circle in list(self.point_to_circles[b]):
       if b in circle.points or b in circle.centers:
         defining_points = circle.defining_points
         if b in defining_points:
@@ -997,17 +1870,10 @@ class DDAR:
             points=[x for x in circle.points if x != b],
             centers=[x for x in circle.centers if x != b],
             value=circle.value,
+            deps=deps | circle.deps,
         )
-        for x, y, z in itertools.permutations(circle2.points, 3):
-          if self.num_identical(x, y):
-            continue
-          if self.num_identical(y, z):
-            continue
-          if self.num_identical(z, x):
-            continue
-          self.triple_to_circle[x, y, z] = circle2
-        self.circles.remove(circle)
-        self.circles.add(circle2)
+        self.remove_circle(circle)
+        self.add_circle(circle2)
 
     # merge in distances
     for x in self.points:
@@ -1016,33 +1882,466 @@ class DDAR:
       if not self.num_identical(x, a) and not self.num_identical(x, b):
         d1 = self.pair_to_dist_mul[x, a]
         d2 = self.pair_to_dist_mul[x, b]
-        self.elim_dist_mul.force_one(d1 / d2)
+        self.elim_dist_mul.force_one(d1 / d2, deps)
 
     # remove 'b' from occuring in self.points
 
-    self.point_subst = {
-        x: y if y != b else a for x, y in self.point_subst.items()
-    }
+    self.point_subst.union(a, b, deps)
 
-    self.points = [x for x in self.points if x != b]
+    self._set_attr('points', [x for x in self.points if x != b])
+    self.produced('points', 'lines', 'circles')
 
   def check_equal_points(self, a, b):
     a = self.point_subst[a]
     b = self.point_subst[b]
     return a == b
 
+  ############# Fact enumeration
+
+  def enumerate_facts(self, kinds=None):
+    """Yields the facts the engine knows, as predicates on current points.
+
+    Facts are read from the database and from groups of pair quantities
+    with equal simplified values, rather than guessed and checked.
+
+    Args:
+      kinds: names of the predicates to produce, all of FACT_KINDS if None.
+        Lines give 'coll', circles with four points or more give 'cyclic'.
+        Lines of equal / perpendicular directions give 'para' / 'perp',
+        pairs of points at equal distances give 'cong'. The angles and the
+        ratios of distances at a vertex give 'eqangle' / 'eqratio', one fact
+        per pair of angles (ratios) not on the same lines (distances). These
+        are built from the lines through each point and the classes of equal
+        distances from it, so only the pairs of distinct lines (distances)
+        at a vertex are visited, not all the triples of points.
+    """
+    kinds = FACT_KINDS if kinds is None else frozenset(kinds)
+
+    if 'coll' in kinds:
+      for line in self.lines:
+        if len(line.points) >= 3:
+          yield AGPredicate('coll', list(line.points), [])
+    if 'cyclic' in kinds:
+      for circle in self.circles:
+        if len(circle.points) >= 4:
+          yield AGPredicate('cyclic', list(circle.points), [])
+
+    if 'para' in kinds or 'perp' in kinds:
+      # lines grouped by the class ids of their directions
+      direction_groups = DefaultDict(list)
+      directions = dict()  # class id -> direction
+      for line in self.lines:
+        key = self.get_point_dir_id(*line.main_pair)
+        if key not in directions:
+          directions[key] = self.get_point_dir(*line.main_pair)
+        direction_groups[key].append(line)
+      right = self.elim_angle.const(1, 2)
+      done = set()
+      for key, lines in direction_groups.items():
+        done.add(key)
+        if 'para' in kinds:
+          for l1, l2 in itertools.combinations(lines, 2):
+            yield AGPredicate('para', [*l1.main_pair, *l2.main_pair], [])
+        perp_direction = self.elim_angle.class_id(directions[key] + right)
+        if 'perp' in kinds and perp_direction not in done:
+          for l1 in lines:
+            for l2 in direction_groups.get(perp_direction, ()):
+              yield AGPredicate('perp', [*l1.main_pair, *l2.main_pair], [])
+
+    if 'cong' in kinds:
+      index = self.point_index
+      for pairs in self.quantity_classes('dist_mul').values():
+        pairs = sorted(pairs, key=lambda pair: (index[pair[0]], index[pair[1]]))
+        for (a, b), (c, d) in itertools.combinations(pairs, 2):
+          yield AGPredicate('cong', [a, b, c, d], [])
+
+    # the angles and ratios are grouped by their class ids
+    if 'eqangle' in kinds:
+      angle_id = self.elim_angle.class_id
+      angles = DefaultDict(dict)
+      mirrors = dict()
+      for a, b, c in self.vertex_triples():
+        angle = self.get_point_dir(a, b) - self.get_point_dir(b, c)
+        key = angle_id(angle)
+        if key not in mirrors:
+          mirrors[key] = angle_id(-angle)
+        lines = self.pair_to_line[a, b], self.pair_to_line[b, c]
+        angles[key].setdefault(lines, (a, b, c))
+      for (a, b, c), (d, e, f) in self.equal_value_pairs(angles, mirrors):
+        yield AGPredicate('eqangle', [a, b, b, c, d, e, e, f], [])
+    if 'eqratio' in kinds:
+      ratio_id = self.elim_dist_mul.class_id
+      ratios = DefaultDict(dict)
+      mirrors = dict()
+      for (a, b, c), (dist1, dist2) in self.vertex_distance_triples():
+        key = ratio_id(dist1 / dist2)
+        if key not in mirrors:
+          mirrors[key] = ratio_id(dist2 / dist1)
+        dists = ratio_id(dist1), ratio_id(dist2)
+        ratios[key].setdefault(dists, (a, b, c))
+      for (a, b, c), (d, e, f) in self.equal_value_pairs(ratios, mirrors):
+        yield AGPredicate('eqratio', [b, a, b, c, e, d, e, f], [])
+
+  def vertex_triples(self):
+    """Yields one triple (a, b, c) per ordered pair of lines ab, bc.
+
+    b is the intersection of the two lines, a and c their first other
+    points; the mirrored triple (c, b, a) is yielded for the swapped lines.
+    """
+    index = self.point_index
+    for b in self.points:
+      ends = [
+          min((x for x in line.points if x != b), key=index.get)
+          for line in self.point_to_lines[b]
+      ]
+      ends.sort(key=index.get)
+      for a, c in itertools.permutations(ends, 2):
+        yield a, b, c
+
+  def vertex_distance_triples(self):
+    """Yields one non-collinear triple per pair of distances from a vertex.
+
+    Yields ((a, b, c), (|ba|, |bc|)) for the simplified distances |ba| and
+    |bc| from b, which differ; the mirrored triple (c, b, a) comes with
+    the swapped distances.
+    """
+    index = self.point_index
+    orientations = self.orientation_rows
+    # vertex -> distance -> the other ends of the segments of that length
+    ends = {x: DefaultDict(list) for x in self.points}
+    for dist, pairs in self.quantity_classes('dist_mul').items():
+      for a, b in pairs:
+        ends[a][dist].append(b)
+        ends[b][dist].append(a)
+    for b in self.points:
+      ib = index[b]
+      groups = [
+          (dist, sorted(xs, key=index.get)) for dist, xs in ends[b].items()
+      ]
+      groups.sort(key=lambda group: index[group[1][0]])
+      for (d1, xs), (d2, ys) in itertools.combinations(groups, 2):
+        for a, c in itertools.product(xs, ys):
+          if orientations[index[a]][ib][index[c]]:
+            yield (a, b, c), (d1, d2)
+            yield (c, b, a), (d2, d1)
+            break
+
+  def equal_value_pairs(self, groups, mirrors):
+    """Yields the pairs of vertex triples of equal value.
+
+    Args:
+      groups: value -> {support: triple}, one triple per support, the pair
+        of objects (lines, distances) that its value is computed from.
+      mirrors: value -> the value of the mirrored triples (c, b, a) of its
+        triples (a, b, c). Of a group and its mirror, only one is reported.
+    """
+    index = self.point_index
+    done = set()
+    for value, triples in groups.items():
+      mirror = mirrors[value]
+      if mirror in done:
+        continue
+      done.add(value)
+      triples = list(triples.values())
+      if mirror == value:  # contains the mirror of each triple
+        triples = [t for t in triples if index[t[0]] < index[t[2]]]
+      yield from itertools.combinations(triples, 2)
+
+  ############# Classes of equal quantities
+
+  def pair_quantity(self, kind):
+    """The elimination, the pair table and the inverse map of a quantity."""
+    if kind == 'dist_mul':
+      return (
+          self.elim_dist_mul, self.pair_to_dist_mul, self.dist_mul_var_to_pair
+      )
+    elif kind == 'dist_add':
+      return (
+          self.elim_dist_add, self.pair_to_dist_add, self.dist_add_var_to_pair
+      )
+    elif kind == 'direction':
+      return self.elim_angle, self.pair_to_dir, self.dir_var_to_pair
+    else:
+      raise ValueError('Not a pair quantity:', kind)
+
+  def update_pair_classes(self, kind):
+    """Brings the class index of a pair quantity up to date, returns it.
+
+    Only the pairs whose variables changed since the last refresh are
+    re-simplified; pairs of merged away points are dropped.
+
+    Args:
+      kind: one of PAIR_QUANTITIES.
+    """
+    elim, table, var_to_pair = self.pair_quantity(kind)
+    index = self.pair_classes[kind]
+    points = set(self.points)
+    points_version = self.object_versions['points']
+    if index is None:
+      index = PairClasses()
+      self.pair_classes[kind] = index
+      pairs = [
+          (a, b)
+          for a, b in itertools.combinations(self.points, 2)
+          if not self.num_identical(a, b)
+      ]
+    else:
+      if index.points_version != points_version:
+        for pair in list(index.values):
+          if not points.issuperset(pair):
+            index.remove(pair)
+      pairs = [
+          var_to_pair[var]
+          for var in elim.changed_since(index.version)
+          if points.issuperset(var_to_pair[var])
+      ]
+    values = elim.simplify_many([table[pair] for pair in pairs])
+    for pair, value in zip(pairs, values):
+      index.move(pair, value)
+    index.version = elim.version
+    index.points_version = points_version
+    return index
+
+  def equal_pairs(self, a, b, kind='dist_mul'):
+    """The pairs whose simplified quantity equals the one of (a, b).
+
+    With 'dist_mul' these are the segments congruent to ab, with
+    'direction' the ones parallel to it; (a, b) itself is included.
+    """
+    a = self.point_subst[a]
+    b = self.point_subst[b]
+    if self.num_identical(a, b):
+      raise ValueError('The pair must have two distinct points')
+    index = self.update_pair_classes(kind)
+    elim, table, _ = self.pair_quantity(kind)
+    return set(index.classes.get(elim.simplify(table[a, b]), ()))
+
+  def quantity_classes(self, kind='dist_mul'):
+    """The classes of pairs with an equal simplified quantity.
+
+    Returns the up to date value -> set of pairs mapping, owned by the
+    index: it must not be modified.
+    """
+    return self.update_pair_classes(kind).classes
+
+  ############# Provenance
+
+  def new_constraint(self, rule, premises=0, pred=None):
+    """Registers an inference step, returns its bitset of one constraint."""
+    self.constraints.append((rule, premises, pred))
+    if self.rule_stats is not None:
+      self.rule_stats.forced += 1
+      self.rule_stats.changed += 1
+    return 1 << (len(self.constraints) - 1)
+
+  def release_constraint(self, deps, changed):
+    """Drops the last registered constraint if its step changed nothing."""
+    if not changed and deps == 1 << (len(self.constraints) - 1):
+      self.constraints.pop()
+      if self.rule_stats is not None:
+        self.rule_stats.changed -= 1
+
+  def count(self, candidates=0, collisions=0):
+    """Adds to the statistics of the running rule."""
+    if self.rule_stats is not None:
+      self.rule_stats.candidates += candidates
+      self.rule_stats.collisions += collisions
+
+  def pairs_deps(self, pairs, *kinds):
+    """Constraints used by the simplified quantities of the point pairs.
+
+    Only the quantities of the given kinds (see PAIR_QUANTITIES) count,
+    the ones the caller actually read.
+    """
+    pairs = [(a, b) for a, b in pairs if not self.num_identical(a, b)]
+    deps = 0
+    for kind in kinds:
+      elim, table, _ = self.pair_quantity(kind)
+      for pair in pairs:
+        deps |= elim.deps_of(table[pair])
+    return deps
+
+  def merge_deps(self, points):
+    """Constraints used by substituting the given points."""
+    deps = 0
+    for x in points:
+      deps |= self.point_subst.deps(x)
+    return deps
+
+  def pred_quantity(self, pred):
+    """The kind of pair quantity a predicate is translated to, or None."""
+    if pred.name in (
+        'angeq', 'para', 'perp', 's_angle', 'aconst', 'eqangle', 'acompute',
+    ):
+      return 'direction'
+    elif pred.name in (
+        'distmeq', 'cong', 'eqratio', 'rconst', 'cyclic_with_centers',
+    ):
+      return 'dist_mul'
+    elif pred.name == 'distseq':
+      return 'dist_add'
+    else:
+      return None
+
+  def pred_pairs(self, pred):
+    """Point pairs whose quantities a predicate is translated from."""
+    if pred.name in (
+        'angeq', 'para', 'perp', 's_angle', 'aconst', 'eqangle', 'acompute',
+        'distmeq', 'cong', 'eqratio', 'rconst', 'distseq',
+    ):
+      return list(zip(pred.points[::2], pred.points[1::2]))
+    elif pred.name == 'cyclic_with_centers':
+      [num_centers] = pred.constants
+      centers = pred.points[:num_centers]
+      points = pred.points[num_centers:]
+      return [(a, c) for a in points for c in centers]
+    else:
+      return []
+
+  def pred_deps(self, pred):
+    """Returns the bitset of constraints a known predicate relies on."""
+    deps = self.merge_deps(pred.points)
+    pred = pred.replace_points(self.point_subst)
+    if pred.name == 'coll':
+      for a, b in itertools.combinations(pred.points, 2):
+        line = self.pair_to_line.get((a, b))
+        if line is not None:
+          return deps | line.deps
+      return deps
+    elif pred.name in ('cyclic', 'cyclic_with_centers'):
+      if pred.name == 'cyclic':
+        points = pred.points
+      else:
+        points = pred.points[pred.constants[0] :]
+      distinct_points = []
+      for x in points:
+        if not any(self.num_identical(x, y) for y in distinct_points):
+          distinct_points.append(x)
+      circle = self.circle_through(*distinct_points[:3])
+      if circle is not None:
+        deps |= circle.deps
+    kind = self.pred_quantity(pred)
+    if kind is None:
+      return deps
+    return deps | self.pairs_deps(self.pred_pairs(pred), kind)
+
+  def traceback(self, pred):
+    """Returns the ids of the constraints a known predicate relies on.
+
+    Premises only refer to constraints registered earlier, so a single
+    descending sweep computes the transitive closure.
+    """
+    deps = self.pred_deps(pred)
+    used = []
+    for cid in range(len(self.constraints) - 1, -1, -1):
+      if deps >> cid & 1:
+        used.append(cid)
+        deps |= self.constraints[cid][1]
+    used.reverse()
+    return used
+
+  ############# Checkpoints
+
+  def checkpoint(self):
+    """Starts recording changes, returns a token to roll back to.
+
+    Rolling back costs time proportional to the changes made since the
+    checkpoint, so many hypotheses can be tried on top of one closed state.
+    """
+    if self.undo_log is None:
+      self.undo_log = []
+      self.point_subst.undo_log = self.undo_log
+    return (
+        len(self.undo_log),
+        len(self.constraints),
+        self.elim_dist_mul.checkpoint(),
+        self.elim_dist_add.checkpoint(),
+        self.elim_angle.checkpoint(),
+        self.dist_mul_cache_version,
+        self.direction_cache_version,
+    )
+
+  def rollback(self, token):
+    """Reverts all the changes made since the checkpoint `token`."""
+    (
+        log_pos,
+        num_constraints,
+        dist_mul_token,
+        dist_add_token,
+        angle_token,
+        self.dist_mul_cache_version,
+        self.direction_cache_version,
+    ) = token
+    el.undo(self.undo_log, log_pos)
+    del self.constraints[num_constraints:]
+    # the similarity, chord and pair class indexes are rebuilt
+    self.similar_versions = None
+    self.concyclic_versions = None
+    self.circles_version = None
+    self.pair_classes = dict.fromkeys(PAIR_QUANTITIES)
+    self.elim_dist_mul.rollback(dist_mul_token)
+    self.elim_dist_add.rollback(dist_add_token)
+    self.elim_angle.rollback(angle_token)
+
+  def _set_item(self, table, key, value):
+    if self.undo_log is not None:
+      self.undo_log.append((table, key, table.get(key, el.UNDO_MISSING)))
+    table[key] = value
+
+  def _set_add(self, s, x):
+    if self.undo_log is not None:
+      self.undo_log.append((s, x, x in s))
+    s.add(x)
+
+  def _set_discard(self, s, x):
+    if self.undo_log is not None:
+      self.undo_log.append((s, x, x in s))
+    s.discard(x)
+
+  def _set_attr(self, name, value):
+    if self.undo_log is not None:
+      self.undo_log.append((self, name, getattr(self, name)))
+    setattr(self, name, value)
+
   #######  low-level functions
 
   def update_cache(self):
-    for a, b in itertools.combinations(self.points, 2):
-      if self.num_identical(a, b):
-        continue
-      dist = self.get_dist_mul(a, b)
-      self.dist_mul_cache[a, b] = dist
-      self.dist_mul_cache[b, a] = dist
-      direction = self.elim_angle.simplify(self.pair_to_dir[a, b])
-      self.direction_cache[a, b] = direction
-      self.direction_cache[b, a] = direction
+    """Re-simplifies the pairs changed since the last update of the caches."""
+    pairs = [
+        self.dist_mul_var_to_pair[var]
+        for var in self.elim_dist_mul.changed_since(self.dist_mul_cache_version)
+    ]
+    dists = self.elim_dist_mul.simplify_many(
+        [self.pair_to_dist_mul[pair] for pair in pairs]
+    )
+    for (a, b), dist in zip(pairs, dists):
+      self._set_item(self.dist_mul_cache, (a, b), dist)
+      self._set_item(
+          self.dist_mul_cache_ids, (a, b), self.elim_dist_mul.class_id(dist)
+      )
+    self.dist_mul_cache_version = self.elim_dist_mul.version
+
+    pairs = [
+        self.dir_var_to_pair[var]
+        for var in self.elim_angle.changed_since(self.direction_cache_version)
+    ]
+    directions = self.elim_angle.simplify_many(
+        [self.pair_to_dir[pair] for pair in pairs]
+    )
+    for (a, b), direction in zip(pairs, directions):
+      self._set_item(self.direction_cache, (a, b), direction)
+      self._set_item(
+          self.direction_cache_ids, (a, b), self.elim_angle.class_id(direction)
+      )
+    self.direction_cache_version = self.elim_angle.version
+
+  def pair_dist_ratio(self, a, b, c, d):
+    """The ratio cd / ab in the unsimplified pair variables."""
+    return self.pair_to_dist_mul[c, d] / self.pair_to_dist_mul[a, b]
+
+  def pair_angle(self, a, b, c, d):
+    """The angle from ab to cd in the unsimplified pair variables."""
+    return self.pair_to_dir[c, d] - self.pair_to_dir[a, b]
 
   def get_dist_ratio(self, a, b, c, d):
     return self.dist_mul_cache[c, d] / self.dist_mul_cache[a, b]
@@ -1052,14 +2351,41 @@ class DDAR:
 
   def get_dist_mul(self, a, b):
     dist_mul = self.pair_to_dist_mul[a, b]
+    if self.elim_dist_mul.core.is_fresh(
+        dist_mul.comb.ids[0], self.dist_mul_cache_version
+    ):
+      return self.dist_mul_cache[a, b]
     return self.elim_dist_mul.simplify(dist_mul)
 
+  def get_dist_mul_id(self, a, b):
+    """Class id of the simplified distance ab, see ElimCore.intern."""
+    dist_mul = self.pair_to_dist_mul[a, b]
+    if self.elim_dist_mul.core.is_fresh(
+        dist_mul.comb.ids[0], self.dist_mul_cache_version
+    ):
+      return self.dist_mul_cache_ids[a, b]
+    return self.elim_dist_mul.class_id(self.elim_dist_mul.simplify(dist_mul))
+
+  def get_point_dir_id(self, a, b):
+    """Class id of the simplified direction ab, see ElimCore.intern."""
+    direction = self.pair_to_dir[a, b]
+    if self.elim_angle.core.is_fresh(
+        direction.comb.ids[0], self.direction_cache_version
+    ):
+      return self.direction_cache_ids[a, b]
+    return self.elim_angle.class_id(self.elim_angle.simplify(direction))
+
   def get_dist_add(self, a, b):
     dist_add = self.pair_to_dist_add[a, b]
     return self.elim_dist_add.simplify(dist_add)
 
   def get_point_dir(self, a, b):
-    return self.elim_angle.simplify(self.pair_to_dir[a, b])
+    direction = self.pair_to_dir[a, b]
+    if self.elim_angle.core.is_fresh(
+        direction.comb.ids[0], self.direction_cache_version
+    ):
+      return self.direction_cache[a, b]
+    return self.elim_angle.simplify(direction)
 
   def get_arc(self, circle, a, b):
     c = next(
@@ -1083,4 +2409,8 @@ class DDAR:
         if self.num_identical(a, b):
           continue
         assert line == self.pair_to_line[a, b]
-        assert line == self.pair_to_line[b, a]
\ No newline at end of file
+        assert line == self.pair_to_line[b, a]
+    for x in self.points:
+      assert self.point_to_lines[x] == {
+          line for line in lines_set if x in line.points
+      }
\ No newline at end of file
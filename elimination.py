@@ -17,21 +17,62 @@
 
 from __future__ import annotations
 
+import bisect
 import collections
+import collections.abc
 import fractions
+import itertools
 import math
+import random
 from typing import Any
 
 import numericals as ng
 
 
+# modulus of the additive LinComb hash and of the optional row
+# fingerprints (a Mersenne prime)
+FINGERPRINT_PRIME = (1 << 61) - 1
+
+_zobrist_rng = random.Random(1)
+_zobrist_keys = dict()
+
+
+def zobrist_key(var_id: int) -> int:
+  """Random key of a variable id, used by the additive LinComb hash."""
+  key = _zobrist_keys.get(var_id)
+  if key is None:
+    key = _zobrist_rng.randrange(1, FINGERPRINT_PRIME)
+    _zobrist_keys[var_id] = key
+  return key
+
+
+def frac_mod(c: fractions.Fraction | int) -> int:
+  """The rational c as a residue modulo FINGERPRINT_PRIME."""
+  c = fractions.Fraction(c)
+  if c.denominator == 1:
+    return c.numerator % FINGERPRINT_PRIME
+  return (
+      c.numerator
+      * pow(c.denominator, -1, FINGERPRINT_PRIME)
+      % FINGERPRINT_PRIME
+  )
+
+
 class ElimVar:
+  """Variable of an elimination system.
+
+  Left-hand side variables get a dense non-negative id when interned by
+  their ElimCore, constants (right-hand side) have fixed negative ids.
+  """
+
+  __slots__ = ("value", "name", "id")
 
   def __init__(
       self, value: int | float | fractions.Fraction, name: str
   ) -> None:
     self.value = value
     self.name = name
+    self.id = None
 
   def __str__(self):
     return self.name
@@ -45,25 +86,149 @@ class ElimRHS(ElimVar):
   pass
 
 
+def const_var(var_id: int) -> ElimRHS:
+  """Returns the constant with the given (negative) id."""
+  if var_id == -1:
+    return angle_unit
+  return DistMulConst.prime_value(-var_id)
+
+
 class LinComb:
-  """Linear combination of variables and constants."""
+  """Linear combination of variables and constants.
+
+  Stored as parallel lists of variable ids (sorted) and coefficients, so
+  that sums are linear merges over ints. `table` is the list of variables
+  of the owning ElimCore, it is only needed to look up variable values and
+  names.
+
+  The hash is additive (Zobrist-style): zhash = sum(coef * zobrist_key(id))
+  modulo FINGERPRINT_PRIME. Being linear, it is updated in O(1) by the
+  arithmetic operations instead of being recomputed from the terms.
+  """
+
+  __slots__ = ("ids", "coefs", "table", "zhash")
 
-  def __init__(self, d: dict[Any, fractions.Fraction]) -> None:
-    self.d = d
+  def __init__(
+      self,
+      ids: list[int],
+      coefs: list[fractions.Fraction],
+      table: list[ElimVar] | None = None,
+      zhash: int | None = None,
+  ) -> None:
+    self.ids = ids
+    self.coefs = coefs
+    self.table = table
+    if zhash is None:
+      zhash = self.compute_zhash()
+    self.zhash = zhash
+
+  def compute_zhash(self) -> int:
+    total = 0
+    for x, c in zip(self.ids, self.coefs):
+      total += frac_mod(c) * zobrist_key(x)
+    return total % FINGERPRINT_PRIME
+
+  @classmethod
+  def from_dict(
+      cls,
+      d: dict[ElimVar, fractions.Fraction | int],
+      table: list[ElimVar] | None = None,
+  ) -> LinComb:
+    items = sorted((x.id, fractions.Fraction(c)) for x, c in d.items() if c)
+    return cls([i for i, _ in items], [c for _, c in items], table)
+
+  def var(self, var_id: int) -> ElimVar:
+    if var_id < 0:
+      return const_var(var_id)
+    return self.table[var_id]
+
+  def items(self):
+    for i, c in zip(self.ids, self.coefs):
+      yield self.var(i), c
+
+  def coef(self, v: ElimVar) -> fractions.Fraction:
+    i = bisect.bisect_left(self.ids, v.id)
+    if i < len(self.ids) and self.ids[i] == v.id:
+      return self.coefs[i]
+    return fractions.Fraction(0)
+
+  def set_coef(self, v: ElimVar, coef: fractions.Fraction) -> None:
+    i = bisect.bisect_left(self.ids, v.id)
+    present = i < len(self.ids) and self.ids[i] == v.id
+    if present:
+      old = self.coefs[i]
+    else:
+      old = 0
+    self.zhash = (
+        self.zhash + frac_mod(coef - old) * zobrist_key(v.id)
+    ) % FINGERPRINT_PRIME
+    if coef == 0:
+      if present:
+        del self.ids[i]
+        del self.coefs[i]
+    elif present:
+      self.coefs[i] = coef
+    else:
+      self.ids.insert(i, v.id)
+      self.coefs.insert(i, coef)
 
   def iadd_mul(self, other: LinComb, coef: fractions.Fraction | int) -> None:
     """In-place add other * coef."""
     assert isinstance(other, LinComb)
-    coef = fractions.Fraction(coef)
-    if coef == 0:
+    if coef == 0 or not other.ids:
+      return
+    if self.table is None:
+      self.table = other.table
+    ids2 = other.ids
+    if coef == 1:
+      coefs2 = other.coefs
+      self.zhash = (self.zhash + other.zhash) % FINGERPRINT_PRIME
+    elif coef == -1:
+      coefs2 = [-c for c in other.coefs]
+      self.zhash = (self.zhash - other.zhash) % FINGERPRINT_PRIME
+    else:
+      coef = fractions.Fraction(coef)
+      coefs2 = [c * coef for c in other.coefs]
+      self.zhash = (
+          self.zhash + frac_mod(coef) * other.zhash
+      ) % FINGERPRINT_PRIME
+    ids1 = self.ids
+    if not ids1:
+      self.ids = list(ids2)
+      self.coefs = list(coefs2)
       return
-    for x, c2 in other.d.items():
-      c1 = self.d.get(x, fractions.Fraction(0))
-      c = c1 + c2 * coef
-      if c == 0:
-        del self.d[x]
+    coefs1 = self.coefs
+    n1 = len(ids1)
+    n2 = len(ids2)
+    ids = []
+    coefs = []
+    i = j = 0
+    while i < n1 and j < n2:
+      x1 = ids1[i]
+      x2 = ids2[j]
+      if x1 < x2:
+        ids.append(x1)
+        coefs.append(coefs1[i])
+        i += 1
+      elif x2 < x1:
+        ids.append(x2)
+        coefs.append(coefs2[j])
+        j += 1
       else:
-        self.d[x] = c
+        c = coefs1[i] + coefs2[j]
+        if c:
+          ids.append(x1)
+          coefs.append(c)
+        i += 1
+        j += 1
+    if i < n1:
+      ids.extend(ids1[i:])
+      coefs.extend(coefs1[i:])
+    elif j < n2:
+      ids.extend(ids2[j:])
+      coefs.extend(coefs2[j:])
+    self.ids = ids
+    self.coefs = coefs
 
   def __iadd__(self, other: LinComb) -> LinComb:
     self.iadd_mul(other, 1)
@@ -87,17 +252,37 @@ class LinComb:
     coef = fractions.Fraction(coef)
     if coef == 0:
       return self.zero()
+    elif coef == -1:
+      return LinComb(
+          list(self.ids),
+          [-c for c in self.coefs],
+          self.table,
+          -self.zhash % FINGERPRINT_PRIME,
+      )
     else:
       return LinComb(
-          {x: c * coef for x, c in self.d.items()},
+          list(self.ids),
+          [c * coef for c in self.coefs],
+          self.table,
+          frac_mod(coef) * self.zhash % FINGERPRINT_PRIME,
       )
 
+  def __eq__(self, other: LinComb) -> bool:
+    return (
+        self.zhash == other.zhash
+        and self.ids == other.ids
+        and self.coefs == other.coefs
+    )
+
+  def __hash__(self) -> int:
+    return self.zhash
+
   def copy(self) -> LinComb:
-    return LinComb(dict(self.d))
+    return LinComb(list(self.ids), list(self.coefs), self.table, self.zhash)
 
   def __str__(self) -> str:
     parts = []
-    for x, c in self.d.items():
+    for x, c in self.items():
       x = str(x)
       if c == 1:
         parts.append(x)
@@ -112,80 +297,546 @@ class LinComb:
     return " + ".join(parts)
 
   @classmethod
-  def singleton(cls, v: ElimVar, coef: fractions.Fraction | int = 1) -> LinComb:
+  def singleton(
+      cls,
+      v: ElimVar,
+      coef: fractions.Fraction | int = 1,
+      table: list[ElimVar] | None = None,
+  ) -> LinComb:
     # assert isinstance(v, ElimVar)
     if coef == 0:
       return LinComb.zero()
     else:
-      return LinComb({v: fractions.Fraction(coef)})
+      return LinComb([v.id], [fractions.Fraction(coef)], table)
 
   @classmethod
   def zero(cls) -> LinComb:
-    return LinComb({})
+    return LinComb([], [], None, 0)
 
 
-class ElimCore:
-  """Core implementation of Gaussian Elimination."""
+UNDO_MISSING = object()  # undo log value of an absent dict entry
 
-  def __init__(self):
+
+def undo(log: list[tuple[Any, Any, Any]], position: int) -> None:
+  """Reverts the undo log entries past `position`, newest first.
+
+  Entries are (container, key, old): for a dict (or another mapping), the
+  old value of the entry (UNDO_MISSING if absent); for a set, whether the
+  key was a member; otherwise, the old value of the attribute `key` of the
+  container.
+  """
+  while len(log) > position:
+    container, key, old = log.pop()
+    if isinstance(container, (dict, collections.abc.MutableMapping)):
+      if old is UNDO_MISSING:
+        del container[key]
+      else:
+        container[key] = old
+    elif isinstance(container, set):
+      if old:
+        container.add(key)
+      else:
+        container.discard(key)
+    else:
+      setattr(container, key, old)
+
+
+class IntRow:
+  """Fraction-free row: integer coefficients over one shared denominator.
+
+  Represents the linear combination sum(num[x] * x) / den, where the keys
+  of `num` are variable ids. Rows are kept normalized, i.e. den > 0 and
+  gcd(den, *num.values()) == 1. `deps` is the bitset of the ids of the
+  constraints the row was derived from.
+  """
+
+  __slots__ = ("num", "den", "deps")
+
+  def __init__(
+      self, num: dict[int, int], den: int = 1, deps: int = 0
+  ) -> None:
+    self.num = num
+    self.den = den
+    self.deps = deps
+
+  @classmethod
+  def from_comb(cls, comb: LinComb) -> IntRow:
+    den = 1
+    for c in comb.coefs:
+      den = math.lcm(den, c.denominator)
+    return cls(
+        {
+            x: c.numerator * (den // c.denominator)
+            for x, c in zip(comb.ids, comb.coefs)
+        },
+        den,
+    )
+
+  def to_comb(self, table: list[ElimVar] | None = None) -> LinComb:
+    den = self.den
+    items = sorted(self.num.items())
+    return LinComb(
+        [x for x, _ in items],
+        [fractions.Fraction(n, den) for _, n in items],
+        table,
+    )
+
+  def normalize(self) -> None:
+    g = math.gcd(self.den, *self.num.values())
+    if g != 1:
+      self.den //= g
+      self.num = {x: n // g for x, n in self.num.items()}
+
+  def iadd_mul(self, other: IntRow, coef_num: int, coef_den: int) -> None:
+    """In-place add other * coef_num / coef_den, without normalizing.
+
+    Cross-multiplies instead of building fractions (Bareiss-style), only
+    dividing out the common factor of the two denominators.
+    """
+    other_den = coef_den * other.den
+    g = math.gcd(self.den, other_den)
+    mul_self = other_den // g
+    mul_other = coef_num * (self.den // g)
+    h = math.gcd(mul_self, mul_other)
+    if h != 1:
+      mul_self //= h
+      mul_other //= h
+    num = self.num
+    if mul_self != 1:
+      for x in num:
+        num[x] *= mul_self
+    for x, n in other.num.items():
+      c = num.get(x, 0) + n * mul_other
+      if c:
+        num[x] = c
+      else:
+        del num[x]
+    self.den *= mul_self
+
+  def copy(self) -> IntRow:
+    return IntRow(dict(self.num), self.den, self.deps)
+
+
+class ElimCore:
+  """Core implementation of Gaussian Elimination.
+
+  Rows are stored as IntRow, so that the elimination itself runs on Python
+  ints; Fractions only appear at the LinComb boundary. Variables are
+  interned to dense ids, indices into `vars`; the rows and usage sets are
+  keyed by those ids.
+
+  Every constraint that changes the basis bumps `version`. The variables
+  whose rows were (re)written by it are stamped in `last_touched` and
+  appended to a change log, so that callers caching simplified values can
+  refresh only what changed (see `changed_since`).
+
+  With `fingerprint` enabled, every variable gets a random residue modulo
+  FINGERPRINT_PRIME, and every row keeps the residue of its substitution.
+  A combination whose fingerprint is nonzero is certainly nonzero after
+  simplification, which is the common answer of the zero tests.
+
+  `pivoting` selects how pivots are chosen: "usage" takes the variable used
+  by the fewest rows, "markowitz" scores every candidate of every row of a
+  batch by (row length - 1) * usage, an estimate of the fill-in the
+  substitution creates, and pivots the best one first. The counters
+  `nonzeros`, `max_row_length` (largest row so far), `fill_in` (entries
+  created in existing rows by the last insertion) and `total_fill_in`
+  measure the density of the basis.
+  """
+
+  def __init__(self, fingerprint: bool = False, pivoting: str = "usage"):
+    if pivoting not in ("usage", "markowitz"):
+      raise ValueError("Unknown pivoting strategy:", pivoting)
+    self.pivoting = pivoting
+    self.nonzeros = 0
+    self.max_row_length = 0
+    self.fill_in = 0
+    self.total_fill_in = 0
+    self.vars = []
     self.instantiated = dict()
     self.free_to_usage = collections.defaultdict(set)
+    self.version = 0
+    self.last_touched = dict()
+    self.change_log = []
+    self.version_to_log_pos = [0]
+    self.fingerprint = fingerprint
+    self.residues = dict()
+    self.row_fingerprints = dict()
+    self.rng = random.Random(0)
+    # None unless a checkpoint was taken; residues are never rolled back,
+    # they are independent of the state
+    self.undo_log = None
+    # the basis exported for simplify_many, see export_basis
+    self.basis = None
+    self.basis_version = 0
+    # hash-consing of simplified combinations, see intern
+    self.intern_ids = dict()
+
+  def new_var(self, value: float, name: str) -> LinComb:
+    var = ElimLHS(value, name)
+    var.id = len(self.vars)
+    self.vars.append(var)
+    return LinComb.singleton(var, table=self.vars)
+
+  def _reduce(self, row: IntRow) -> IntRow:
+    """Substitutes all instantiated variables in the row (in place)."""
+    instantiated = self.instantiated
+    for v in [v for v in row.num if v in instantiated]:
+      eq = instantiated[v]
+      row.iadd_mul(eq, row.num[v], row.den)
+      row.deps |= eq.deps
+    row.normalize()
+    return row
 
   def simplify(self, comb: LinComb) -> LinComb:
-    updates = list(comb.d.items())
-    denom = 1
-    for v, coef in updates:
-      eq = self.instantiated.get(v)
-      if eq is None:
-        continue
-      comb.iadd_mul(eq, coef)
-      denom = math.lcm(denom, coef.denominator)
+    if not any(v in self.instantiated for v in comb.ids):
+      return comb
+    row = self._reduce(IntRow.from_comb(comb))
+    res = row.to_comb()
+    comb.ids = res.ids
+    comb.coefs = res.coefs
+    comb.zhash = res.zhash
     return comb
 
-  def add_constraint(self, added_eq: LinComb) -> bool:
-    """Add a constraint to the system."""
-    self.simplify(added_eq)
-    lhs = [x for x in added_eq.d.keys() if isinstance(x, ElimLHS)]
-    if not lhs:
-      return False
-    pivot = min(lhs, key=lambda x: len(self.free_to_usage[x]))
-    del lhs[lhs.index(pivot)]
-    coef = fractions.Fraction(-1) / added_eq.d[pivot]
-    added_eq *= coef
-
-    for x in self.free_to_usage[pivot]:
-      eq = self.instantiated[x]
-      coef = eq.d[pivot]
-      eq.iadd_mul(added_eq, coef)
-      for y in lhs:
-        if y in eq.d:
-          self.free_to_usage[y].add(x)
-        else:
-          self.free_to_usage[y].remove(x)
+  def intern(self, comb: LinComb) -> int:
+    """Small integer id of a simplified combination (hash-consing).
+
+    Equal combinations get equal ids, handed out in order of appearance:
+    the zhash and the ids / coefs comparison run once here, and the
+    callers compare ints from then on. The table only grows, so an id stays
+    valid across basis versions (and rollbacks): the ids cached for values
+    that did not change remain comparable with fresh ones.
+    """
+    ids = self.intern_ids
+    i = ids.get(comb)
+    if i is None:
+      i = ids[comb.copy()] = len(ids)
+    return i
+
+  def export_basis(self) -> dict[int, tuple[list[int], list[int], int]]:
+    """The reduced basis as sparse integer rows, refreshed incrementally.
+
+    Maps every instantiated variable v to (ids, nums, den) such that
+    v = sum(num * x for x, num in zip(ids, nums)) / den, ids being free.
+    """
+    if self.basis is None:
+      changed = self.instantiated.keys()
+      self.basis = dict()
+    else:
+      changed = self.changed_since(self.basis_version)
+    for v in changed:
+      row = self.instantiated[v]
+      ids = sorted(x for x in row.num if x != v)
+      self.basis[v] = ids, [row.num[x] for x in ids], row.den
+    self.basis_version = self.version
+    return self.basis
+
+  def simplify_many(self, combs: list[LinComb]) -> list[LinComb]:
+    """Simplifies many combinations at once, returns new combinations.
+
+    The combinations form a sparse matrix, which is multiplied with the
+    exported basis in exact integers: every result row is accumulated over
+    one shared denominator, and only then turned into Fractions.
+    """
+    basis = self.export_basis()
+    res = []
+    for comb in combs:
+      used = [v for v in comb.ids if v in basis]
+      if not used:
+        res.append(comb.copy())
+        continue
+      # every term is over c.denominator, times row_den if substituted
+      den = 1
+      for v, c in zip(comb.ids, comb.coefs):
+        row = basis.get(v)
+        term_den = c.denominator if row is None else c.denominator * row[2]
+        den = math.lcm(den, term_den)
+      acc = collections.defaultdict(int)
+      for v, c in zip(comb.ids, comb.coefs):
+        row = basis.get(v)
+        if row is None:
+          acc[v] += c.numerator * (den // c.denominator)
+          continue
+        ids, nums, row_den = row
+        mul = c.numerator * (den // (c.denominator * row_den))
+        for x, n in zip(ids, nums):
+          acc[x] += mul * n
+      ids = sorted(x for x, n in acc.items() if n)
+      coefs = [fractions.Fraction(acc[x], den) for x in ids]
+      res.append(LinComb(ids, coefs, comb.table))
+    return res
 
-    self.instantiated[pivot] = added_eq
-    for y in lhs:
-      self.free_to_usage[y].add(pivot)
+  def simplify_many_sanity_check(self, num_combs: int = 200, seed: int = 0):
+    """Compares simplify_many with simplify on random fractional combs."""
+    rng = random.Random(seed)
+    combs = []
+    for _ in range(num_combs):
+      size = min(len(self.vars), rng.randint(1, 4))
+      ids = sorted(rng.sample(range(len(self.vars)), size))
+      coefs = [
+          fractions.Fraction(rng.choice((-1, 1)) * rng.randint(1, 6),
+                             rng.randint(1, 6))
+          for _ in ids
+      ]
+      combs.append(LinComb(ids, coefs, self.vars))
+    for comb, res in zip(combs, self.simplify_many(combs)):
+      expected = self.simplify(comb.copy())
+      assert res == expected, (str(comb), str(res), str(expected))
+
+  def add_constraint(self, added_eq: LinComb, deps: int = 0) -> bool:
+    """Add a constraint to the system.
+
+    `deps` is the bitset of constraint ids this constraint stands for, it
+    is propagated to every row the constraint gets substituted into.
+    """
+    return self.add_constraints([added_eq], deps)
+
+  def add_constraints(self, batch: list[LinComb], deps: int = 0) -> bool:
+    """Adds several constraints at once, returns whether any was new.
+
+    The batch is reduced against the current basis and eliminated within
+    itself first, so the existing rows depending on its pivots are
+    rewritten only once, whatever the size of the batch.
+    """
+    instantiated = self.instantiated
+    log = self.undo_log
+
+    pending = []
+    for added_eq in batch:
+      row = IntRow.from_comb(added_eq)
+      row.deps = deps
+      pending.append(self._reduce(row))
+
+    # eliminate inside the batch, keeping the new rows mutually reduced
+    new_rows = dict()
+    while pending:
+      row, pivot = self._choose_pivot(pending)
+      if pivot is None:
+        continue
+      # scale so that the pivot has coefficient -1
+      pivot_coef = row.num[pivot]
+      if pivot_coef > 0:
+        row.num = {x: -n for x, n in row.num.items()}
+      row.den = abs(pivot_coef)
+      row.normalize()
+      for eq in itertools.chain(new_rows.values(), pending):
+        if pivot in eq.num:
+          eq.iadd_mul(row, eq.num[pivot], eq.den)
+          eq.normalize()
+          eq.deps |= row.deps
+      new_rows[pivot] = row
+    if not new_rows:
+      return False
+    if log is not None:
+      log.append((self, "nonzeros", self.nonzeros))
+      log.append((self, "max_row_length", self.max_row_length))
+      log.append((self, "fill_in", self.fill_in))
+      log.append((self, "total_fill_in", self.total_fill_in))
+    nonzeros = self.nonzeros
+    max_row_length = self.max_row_length
+    fill_in = 0
+
+    free = set()
+    for row in new_rows.values():
+      free.update(x for x in row.num if x >= 0 and x not in new_rows)
+    if log is not None:
+      for x in free:
+        if x not in self.free_to_usage:
+          log.append((self.free_to_usage, x, UNDO_MISSING))
+
+    # back-substitute into the existing rows, once per row
+    dependent = set()
+    for pivot in new_rows:
+      dependent.update(self.free_to_usage.get(pivot, ()))
+    for x in dependent:
+      eq = instantiated[x]
+      if log is not None:
+        log.append((instantiated, x, eq.copy()))
+      nonzeros -= len(eq.num)
+      for v in [v for v in eq.num if v in new_rows]:
+        row = new_rows[v]
+        eq.iadd_mul(row, eq.num[v], eq.den)
+        eq.deps |= row.deps
+      eq.normalize()
+      nonzeros += len(eq.num)
+      max_row_length = max(max_row_length, len(eq.num))
+      for y in free:
+        usage = self.free_to_usage[y]
+        if y in eq.num:
+          if x not in usage:
+            fill_in += 1
+            if log is not None:
+              log.append((usage, x, False))
+          usage.add(x)
+        elif x in usage:
+          if log is not None:
+            log.append((usage, x, True))
+          usage.remove(x)
+
+    for pivot, row in new_rows.items():
+      if log is not None:
+        log.append((instantiated, pivot, UNDO_MISSING))
+      instantiated[pivot] = row
+      nonzeros += len(row.num)
+      max_row_length = max(max_row_length, len(row.num))
+      for y in row.num:
+        if y >= 0 and y != pivot:
+          if log is not None:
+            log.append((self.free_to_usage[y], pivot, False))
+          self.free_to_usage[y].add(pivot)
+    self.nonzeros = nonzeros
+    self.max_row_length = max_row_length
+    self.fill_in = fill_in
+    self.total_fill_in += fill_in
+
+    self.version += 1
+    touched = [*new_rows, *dependent]
+    if log is not None:
+      log.extend(
+          (self.last_touched, x, self.last_touched.get(x, UNDO_MISSING))
+          for x in touched
+      )
+    for x in touched:
+      self.last_touched[x] = self.version
+    self.change_log.extend(touched)
+    self.version_to_log_pos.append(len(self.change_log))
+
+    if self.fingerprint:
+      for x in touched:
+        self._update_row_fingerprint(x)
     return True
 
+  def _choose_pivot(self, pending: list[IntRow]) -> tuple[IntRow, int | None]:
+    """Takes the next row to pivot out of `pending`, with its pivot.
+
+    The pivot is None if the row reduced to a constant one.
+    """
+    usage = self.free_to_usage
+    if self.pivoting == "usage":
+      row = pending.pop(0)
+      lhs = [x for x in row.num.keys() if x >= 0]  # ElimLHS
+      if not lhs:
+        return row, None
+      return row, min(lhs, key=lambda x: len(usage.get(x, ())))
+
+    best = None
+    for i, row in enumerate(pending):
+      for x in row.num.keys():
+        if x < 0:
+          continue
+        score = (len(row.num) - 1) * len(usage.get(x, ()))
+        if best is None or score < best[0]:
+          best = score, i, x
+    if best is None:
+      return pending.pop(), None
+    _, i, pivot = best
+    return pending.pop(i), pivot
+
+  def deps_of(self, comb: LinComb) -> int:
+    """Bitset of the constraints used by simplify(comb)."""
+    deps = 0
+    for x in comb.ids:
+      row = self.instantiated.get(x)
+      if row is not None:
+        deps |= row.deps
+    return deps
+
+  def checkpoint(self) -> tuple[int, int, int]:
+    """Starts recording changes, returns a token to roll back to."""
+    if self.undo_log is None:
+      self.undo_log = []
+    return len(self.undo_log), len(self.vars), self.version
+
+  def rollback(self, token: tuple[int, int, int]) -> None:
+    """Reverts all the changes made since the checkpoint `token`."""
+    log_pos, num_vars, version = token
+    undo(self.undo_log, log_pos)
+    del self.vars[num_vars:]
+    # the version numbers past `version` get reused
+    self.basis = None
+    self.version = version
+    del self.change_log[self.version_to_log_pos[version] :]
+    del self.version_to_log_pos[version + 1 :]
+
+  def changed_since(self, version: int) -> set[int]:
+    """Ids of the variables whose simplified value changed since `version`."""
+    return set(self.change_log[self.version_to_log_pos[version] :])
+
+  def is_fresh(self, var_id: int, version: int) -> bool:
+    """Whether the simplified variable is unchanged since `version`."""
+    return self.last_touched.get(var_id, 0) <= version
+
+  def _residue(self, var_id: int) -> int:
+    res = self.residues.get(var_id)
+    if res is None:
+      res = self.rng.randrange(1, FINGERPRINT_PRIME)
+      self.residues[var_id] = res
+    return res
+
+  def _update_row_fingerprint(self, var_id: int) -> None:
+    row = self.instantiated[var_id]
+    total = 0
+    for x, n in row.num.items():
+      if x != var_id:
+        total += n * self._residue(x)
+    if self.undo_log is not None:
+      self.undo_log.append((
+          self.row_fingerprints,
+          var_id,
+          self.row_fingerprints.get(var_id, UNDO_MISSING),
+      ))
+    self.row_fingerprints[var_id] = (
+        total * pow(row.den, -1, FINGERPRINT_PRIME) % FINGERPRINT_PRIME
+    )
+
+  def fingerprint_of(self, comb: LinComb) -> int:
+    """Residue of the simplified combination modulo FINGERPRINT_PRIME."""
+    total = 0
+    for x, c in zip(comb.ids, comb.coefs):
+      fp = self.row_fingerprints.get(x)
+      if fp is None:
+        fp = self._residue(x)
+      total += frac_mod(c) * fp
+    return total % FINGERPRINT_PRIME
+
+  def maybe_zero(self, comb: LinComb) -> bool:
+    """False only if the combination certainly does not simplify to zero."""
+    if not self.fingerprint:
+      return True
+    return self.fingerprint_of(comb) == 0
+
   def display(self) -> None:
     print("Matrix:")
-    for v, comb in self.instantiated.items():
-      comb = comb.copy()
-      comb += LinComb.singleton(v)
+    for v, row in self.instantiated.items():
+      comb = row.to_comb(self.vars)
+      comb += LinComb.singleton(self.vars[v])
+      v = self.vars[v]
       print(f"  {v} = {comb}")
 
   def clone(self) -> ElimCore:
-    res = ElimCore()
-    for v, lc in self.instantiated.items():
-      res.instantiated[v] = lc.copy()
+    res = ElimCore(fingerprint=self.fingerprint, pivoting=self.pivoting)
+    res.nonzeros = self.nonzeros
+    res.max_row_length = self.max_row_length
+    res.fill_in = self.fill_in
+    res.total_fill_in = self.total_fill_in
+    res.vars = list(self.vars)
+    for v, row in self.instantiated.items():
+      res.instantiated[v] = row.copy()
     for v, usage in self.free_to_usage.items():
       res.free_to_usage[v] = set(usage)
+    res.version = self.version
+    res.last_touched = dict(self.last_touched)
+    res.change_log = list(self.change_log)
+    res.version_to_log_pos = list(self.version_to_log_pos)
+    res.residues = dict(self.residues)
+    res.row_fingerprints = dict(self.row_fingerprints)
+    res.rng.setstate(self.rng.getstate())
+    res.intern_ids = dict(self.intern_ids)
     return res
 
   def was_encountered(self, comb: LinComb) -> bool:
-    assert len(comb.d) == 1
-    [(v, _)] = comb.d.items()
+    assert len(comb.ids) == 1
+    [v] = comb.ids
     if v in self.instantiated:
       return True
     if v in self.free_to_usage:
@@ -202,7 +853,9 @@ class DistMulConst(ElimRHS):
   @classmethod
   def prime_value(cls, p):
     if p not in cls.prime_to_const:
-      cls.prime_to_const[p] = cls(p, f"log({p})")
+      const = cls(p, f"log({p})")
+      const.id = -p
+      cls.prime_to_const[p] = const
     return cls.prime_to_const[p]
 
 
@@ -238,7 +891,6 @@ class DistMul:
     self.comb = comb
     self._key = None
     self._value = None
-    self._hash = None
 
   @classmethod
   def frac_value(cls, frac_const: float | int | str) -> DistMul:
@@ -256,32 +908,33 @@ class DistMul:
         (DistMulConst.prime_value(p), -e)
         for p, e in prime_decomposition(frac_const.denominator)
     )
-    return DistMul(LinComb(res))
+    return DistMul(LinComb.from_dict(res))
 
   def normalize(self) -> tuple[DistMul, fractions.Fraction]:
     """Normalize the multiplicative distance."""
-    normalized = {
-        x: exp
-        for x, exp in self.comb.d.items()
-        if not isinstance(x, DistMulConst)
-    }
+    ids = []
+    coefs = []
     numerator = 1
     denominator = 1
-    for x, exp in self.comb.d.items():
-      if isinstance(x, DistMulConst):
+    for x, exp in zip(self.comb.ids, self.comb.coefs):
+      if x < 0:  # DistMulConst, log(-x)
         if exp % 1 != 0:
-          normalized[x] = exp % 1
+          ids.append(x)
+          coefs.append(exp % 1)
           exp = exp // 1
         exp = int(exp)
         if exp > 0:
-          numerator *= x.value**exp
+          numerator *= (-x) ** exp
         else:
-          denominator *= x.value ** (-exp)
+          denominator *= (-x) ** (-exp)
+      else:
+        ids.append(x)
+        coefs.append(exp)
     coef = fractions.Fraction(numerator, denominator)
-    return DistMul(LinComb(normalized)), coef
+    return DistMul(LinComb(ids, coefs, self.comb.table)), coef
 
   def is_one(self) -> bool:
-    return not self.comb.d
+    return not self.comb.ids
 
   # arithmetics
 
@@ -301,7 +954,7 @@ class DistMul:
   def value(self) -> float:
     if self._value is None:
       self._value = 1.0
-      for v, exp in self.comb.d.items():
+      for v, exp in self.comb.items():
         if exp == 1:
           self._value *= v.value
         else:
@@ -310,41 +963,75 @@ class DistMul:
 
   # hashing
   def __eq__(self, other: DistMul) -> bool:
-    return self.comb.d == other.comb.d
+    return self.comb == other.comb
 
   def __hash__(self) -> int:
-    if self._hash is None:
-      self._hash = hash(frozenset(self.comb.d.items()))
-    return self._hash
+    return self.comb.zhash
 
 
 class ElimDistMul:
   """Gaussian Elim for Multiplicative Distance."""
 
-  def __init__(self):
-    self.core = ElimCore()
+  def __init__(self, fingerprint: bool = False, pivoting: str = "usage"):
+    self.core = ElimCore(fingerprint=fingerprint, pivoting=pivoting)
 
   def new_var(self, value: float, name: str) -> DistMul:
-    return DistMul(LinComb.singleton(ElimLHS(value, name)))
+    return DistMul(self.core.new_var(value, name))
 
-  def force_one(self, dist_mul: DistMul) -> bool:
+  def force_one(self, dist_mul: DistMul, deps: int = 0) -> bool:
     assert abs(dist_mul.value - 1.0) ** 2 < ng.ATOM, dist_mul.value
     comb = dist_mul.comb.copy()
-    return self.core.add_constraint(comb)
+    return self.core.add_constraint(comb, deps)
+
+  def force_ones(self, dist_muls: list[DistMul], deps: int = 0) -> bool:
+    """Batched force_one, see ElimCore.add_constraints."""
+    for dist_mul in dist_muls:
+      assert abs(dist_mul.value - 1.0) ** 2 < ng.ATOM, dist_mul.value
+    combs = [dist_mul.comb.copy() for dist_mul in dist_muls]
+    return self.core.add_constraints(combs, deps)
 
   def simplify(self, dist_mul: DistMul) -> DistMul:
     comb = dist_mul.comb.copy()
     self.core.simplify(comb)
     return DistMul(comb)
 
+  def simplify_many(self, dist_muls: list[DistMul]) -> list[DistMul]:
+    combs = self.core.simplify_many([x.comb for x in dist_muls])
+    return [DistMul(comb) for comb in combs]
+
+  def class_id(self, dist_mul: DistMul) -> int:
+    """Id of a simplified value, equal ids for equal values, see intern."""
+    return self.core.intern(dist_mul.comb)
+
+  def deps_of(self, dist_mul: DistMul) -> int:
+    return self.core.deps_of(dist_mul.comb)
+
+  def is_one(self, dist_mul: DistMul) -> bool:
+    if not self.core.maybe_zero(dist_mul.comb):
+      return False
+    return self.simplify(dist_mul).is_one()
+
   def clone(self) -> ElimDistMul:
     res = ElimDistMul()
     res.core = self.core.clone()
     return res
 
+  def checkpoint(self) -> tuple[int, int, int]:
+    return self.core.checkpoint()
+
+  def rollback(self, token: tuple[int, int, int]) -> None:
+    self.core.rollback(token)
+
   def was_encountered(self, dist_mul: DistMul) -> bool:
     return self.core.was_encountered(dist_mul.comb)
 
+  @property
+  def version(self) -> int:
+    return self.core.version
+
+  def changed_since(self, version: int) -> set[int]:
+    return self.core.changed_since(version)
+
 
 class DistAdd:
   """Additive distance."""
@@ -353,14 +1040,13 @@ class DistAdd:
     self.comb = comb
     self._key = None
     self._value = None
-    self._hash = None
 
   def normalize(self) -> tuple[DistAdd, fractions.Fraction | int]:
-    c = min(abs(c) for x, c in self.comb.d.items() if isinstance(x, ElimLHS))
+    c = min(abs(c) for x, c in zip(self.comb.ids, self.comb.coefs) if x >= 0)
     return self / c, c
 
   def is_zero(self) -> bool:
-    return not self.comb.d
+    return not self.comb.ids
 
   # arithmetics
   def __mul__(self, other: fractions.Fraction | int) -> DistAdd:
@@ -383,52 +1069,87 @@ class DistAdd:
   def value(self) -> float:
     if self._value is None:
       self._value = 0.0
-      for v, c in self.comb.d.items():
+      for v, c in self.comb.items():
         self._value += c * v.value
     return self._value
 
   # hashing
   def __eq__(self, other: DistAdd) -> bool:
-    return self.comb.d == other.comb.d
+    return self.comb == other.comb
 
   def __hash__(self) -> int:
-    if self._hash is None:
-      self._hash = hash(frozenset(self.comb.d.items()))
-    return self._hash
+    return self.comb.zhash
 
 
 class ElimDistAdd:
   """Gaussian Elim for Additive Distance."""
 
-  def __init__(self):
-    self.core = ElimCore()
+  def __init__(self, fingerprint: bool = False, pivoting: str = "usage"):
+    self.core = ElimCore(fingerprint=fingerprint, pivoting=pivoting)
 
   def new_var(self, value: float, name: str) -> DistAdd:
-    return DistAdd(LinComb.singleton(ElimLHS(value, name)))
+    return DistAdd(self.core.new_var(value, name))
 
-  def force_zero(self, dist_add: DistAdd) -> bool:
+  def force_zero(self, dist_add: DistAdd, deps: int = 0) -> bool:
     assert abs(dist_add.value) ** 2 < ng.ATOM
     comb = dist_add.comb.copy()
-    return self.core.add_constraint(comb)
+    return self.core.add_constraint(comb, deps)
+
+  def force_zeros(self, dist_adds: list[DistAdd], deps: int = 0) -> bool:
+    """Batched force_zero, see ElimCore.add_constraints."""
+    for dist_add in dist_adds:
+      assert abs(dist_add.value) ** 2 < ng.ATOM
+    combs = [dist_add.comb.copy() for dist_add in dist_adds]
+    return self.core.add_constraints(combs, deps)
 
   def simplify(self, dist_add: DistAdd) -> DistAdd:
     comb = dist_add.comb.copy()
     self.core.simplify(comb)
     return DistAdd(comb)
 
+  def simplify_many(self, dist_adds: list[DistAdd]) -> list[DistAdd]:
+    combs = self.core.simplify_many([x.comb for x in dist_adds])
+    return [DistAdd(comb) for comb in combs]
+
+  def class_id(self, dist_add: DistAdd) -> int:
+    """Id of a simplified value, equal ids for equal values, see intern."""
+    return self.core.intern(dist_add.comb)
+
+  def deps_of(self, dist_add: DistAdd) -> int:
+    return self.core.deps_of(dist_add.comb)
+
+  def is_zero(self, dist_add: DistAdd) -> bool:
+    if not self.core.maybe_zero(dist_add.comb):
+      return False
+    return self.simplify(dist_add).is_zero()
+
   def clone(self) -> ElimDistAdd:
     res = ElimDistAdd()
     res.core = self.core.clone()
     return res
 
+  def checkpoint(self) -> tuple[int, int, int]:
+    return self.core.checkpoint()
+
+  def rollback(self, token: tuple[int, int, int]) -> None:
+    self.core.rollback(token)
+
   def was_encountered(self, dist_add: DistAdd) -> bool:
     return self.core.was_encountered(dist_add.comb)
 
+  @property
+  def version(self) -> int:
+    return self.core.version
+
+  def changed_since(self, version: int) -> set[int]:
+    return self.core.changed_since(version)
+
 
 class AngleUnit(ElimRHS):
 
   def __init__(self):
     super().__init__(1, "pi")
+    self.id = -1
 
 
 angle_unit = AngleUnit()
@@ -439,25 +1160,20 @@ class FormalAngle:
 
   def __init__(self, comb: LinComb) -> None:
     self.comb = comb
-    const = self.comb.d.get(angle_unit, fractions.Fraction(0))
+    const = self.comb.coef(angle_unit)
     if const.numerator // const.denominator:
-      const = const % 1
-      if const == 0:
-        del self.comb.d[angle_unit]
-      else:
-        self.comb.d[angle_unit] = const
+      self.comb.set_coef(angle_unit, const % 1)
     self._key = None
     self._value = None
-    self._hash = None
 
   @property
   def value(self) -> float:
     if self._value is None:
-      self._value = sum(x.value * c for x, c in self.comb.d.items())
+      self._value = sum(x.value * c for x, c in self.comb.items())
     return self._value
 
   def is_zero(self) -> bool:
-    return not self.comb.d
+    return not self.comb.ids
 
   # arithmetics
   def __neg__(self) -> FormalAngle:
@@ -475,19 +1191,20 @@ class FormalAngle:
 
   # hashing
   def __eq__(self, other: FormalAngle) -> bool:
-    return self.comb.d == other.comb.d
+    return self.comb == other.comb
 
   def __hash__(self) -> int:
-    if self._hash is None:
-      self._hash = hash(frozenset(self.comb.d.items()))
-    return self._hash
+    return self.comb.zhash
 
 
 class ElimAngle:
   """Gaussian Elim for Angle."""
 
-  def __init__(self):
-    self.core = ElimCore()
+  def __init__(self, fingerprint: bool = False, pivoting: str = "usage"):
+    self.core = ElimCore(fingerprint=fingerprint, pivoting=pivoting)
+    # angles are taken modulo the angle unit, so it must not contribute
+    # to the fingerprints
+    self.core.residues[angle_unit.id] = 0
 
   def const(self, numerator: int, denominator: int) -> FormalAngle:
     return self.const_frac(fractions.Fraction(numerator, denominator))
@@ -496,9 +1213,18 @@ class ElimAngle:
     return FormalAngle(LinComb.singleton(angle_unit, coef=frac_value))
 
   def new_var(self, value: float, name: str) -> FormalAngle:
-    return FormalAngle(LinComb.singleton(ElimLHS(value, name)))
+    return FormalAngle(self.core.new_var(value, name))
+
+  def force_zero(self, angle: FormalAngle, deps: int = 0) -> bool:
+    return self.core.add_constraint(self._to_constraint(angle), deps)
 
-  def force_zero(self, angle: FormalAngle) -> bool:
+  def force_zeros(self, angles: list[FormalAngle], deps: int = 0) -> bool:
+    """Batched force_zero, see ElimCore.add_constraints."""
+    combs = [self._to_constraint(angle) for angle in angles]
+    return self.core.add_constraints(combs, deps)
+
+  def _to_constraint(self, angle: FormalAngle) -> LinComb:
+    """The combination to be zero, with the full turns of `angle` removed."""
     assert abs((angle.value + 0.5) % 1 - 0.5) ** 2 < ng.ATOM, (
         abs((angle.value + 0.5) % 1 - 0.5) ** 2
     )
@@ -506,17 +1232,46 @@ class ElimAngle:
     comb -= LinComb.singleton(
         angle_unit, fractions.Fraction(math.floor(angle.value + 0.5))
     )
-    return self.core.add_constraint(comb)
+    return comb
 
   def simplify(self, angle: FormalAngle) -> FormalAngle:
     comb = angle.comb.copy()
     self.core.simplify(comb)
     return FormalAngle(comb)
 
+  def simplify_many(self, angles: list[FormalAngle]) -> list[FormalAngle]:
+    combs = self.core.simplify_many([x.comb for x in angles])
+    return [FormalAngle(comb) for comb in combs]
+
+  def class_id(self, angle: FormalAngle) -> int:
+    """Id of a simplified value, equal ids for equal values, see intern."""
+    return self.core.intern(angle.comb)
+
+  def deps_of(self, angle: FormalAngle) -> int:
+    return self.core.deps_of(angle.comb)
+
+  def is_zero(self, angle: FormalAngle) -> bool:
+    if not self.core.maybe_zero(angle.comb):
+      return False
+    return self.simplify(angle).is_zero()
+
   def clone(self) -> ElimAngle:
     res = ElimAngle()
     res.core = self.core.clone()
     return res
 
+  def checkpoint(self) -> tuple[int, int, int]:
+    return self.core.checkpoint()
+
+  def rollback(self, token: tuple[int, int, int]) -> None:
+    self.core.rollback(token)
+
   def was_encountered(self, angle):
-    return self.core.was_encountered(angle.comb)
\ No newline at end of file
+    return self.core.was_encountered(angle.comb)
+
+  @property
+  def version(self) -> int:
+    return self.core.version
+
+  def changed_since(self, version: int) -> set[int]:
+    return self.core.changed_since(version)
\ No newline at end of file
@@ -8,13 +8,15 @@ from generation.masker import mask_environment
 from generation.snapshot_generator import generate_solution_snapshots
 from dataset.exporter import export_sample
 
-def generate_sample(seed=None, variant_id=0):
+def generate_sample(seed=None, variant_id=0, budget=None):
     """
     Gera um sample completo do dataset.
     
     Args:
         seed: semente para randomização
         variant_id: ID da variante geométrica (0=original, 1=espelhado, etc.)
+        budget: ddar.Budget opcional limitando a dedução (tempo, rodadas...);
+            se for atingido, usa os fatos deduzidos até então
     
     Returns:
         dict: sample completo no formato do dataset, ou None se falhar
@@ -32,7 +34,7 @@ def generate_sample(seed=None, variant_id=0):
         for f in facts:
             ddar.add_fact(f)
 
-        ddar.run()
+        ddar.run(budget=budget)
 
         all_facts = ddar.all_facts()
 
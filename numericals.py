@@ -39,13 +39,35 @@ def direction(v: NumPoint) -> float:
   return np.arctan2(y, x) / np.pi
 
 
+def pairwise_lines(
+    points: np.ndarray,
+) -> tuple[np.ndarray, np.ndarray, np.ndarray, np.ndarray]:
+  """Distances and lines of all the pairs of points, in one pass.
+
+  For points given as an n x 2 array, returns the n x n distances, the
+  n x n x 2 normals and n x n offsets such that the line through points i
+  and j is NumLine(normals[i, j], offsets[i, j]), and the n x n directions
+  of these lines. Entries of coinciding points are meaningless.
+  """
+  diff = points[None, :, :] - points[:, None, :]
+  dist = np.linalg.norm(diff, axis=-1)
+  with np.errstate(divide="ignore", invalid="ignore"):
+    unit = diff / dist[:, :, None]
+  normals = np.stack((unit[..., 1], -unit[..., 0]), axis=-1)
+  offsets = np.einsum("ik,ijk->ij", points, normals)
+  directions = (np.arctan2(normals[..., 1], normals[..., 0]) / np.pi + 0.5) % 1
+  return dist, normals, offsets, directions
+
+
 def midpoint(a: NumPoint, b: NumPoint) -> NumPoint:
   return (a + b) / 2
 
 
 def orientation(a: NumPoint, b: NumPoint, c: NumPoint) -> int:
-  matrix = np.stack((b - a, c - a))
-  det = np.linalg.det(matrix)
+  # the 2x2 determinant written out, np.linalg.det is slow on scalars
+  det = float(
+      (b[0] - a[0]) * (c[1] - a[1]) - (b[1] - a[1]) * (c[0] - a[0])
+  )
   if det > ATOM:
     return 1
   elif det < -ATOM:
@@ -58,6 +80,22 @@ def collinear(a: NumPoint, b: NumPoint, c: NumPoint) -> bool:
   return orientation(a, b, c) == 0
 
 
+def orientations(points: np.ndarray) -> np.ndarray:
+  """Orientations of all the triples of points, in one pass.
+
+  For points given as an n x 2 array, returns the n x n x n int8 array whose
+  entry [i, j, k] is orientation(points[i], points[j], points[k]).
+  """
+  diff = points[None, :, :] - points[:, None, :]
+  det = (
+      diff[:, :, None, 0] * diff[:, None, :, 1]
+      - diff[:, :, None, 1] * diff[:, None, :, 0]
+  )
+  return (
+      (det > ATOM).astype(np.int8) - (det < -ATOM).astype(np.int8)
+  )
+
+
 class NumLine:
   """A point x is in the line if x*n = c where n is a vector of unit length."""
 
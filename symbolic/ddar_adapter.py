@@ -39,6 +39,41 @@ def fact_to_predicate(fact, points_dict):
     
     return AGPredicate(name=pred_name, points=points, constants=constants)
 
+def _orbit_min(pairs, moves):
+    """Menor tupla da órbita de `pairs` sob as permutações `moves`."""
+    orbit = {pairs}
+    frontier = [pairs]
+    while frontier:
+        current = frontier.pop()
+        for move in moves:
+            image = tuple(current[i] for i in move)
+            if image not in orbit:
+                orbit.add(image)
+                frontier.append(image)
+    return min(orbit)
+
+# simetrias de ab/cd = ef/gh (ângulos ou razões): trocar os lados,
+# inverter os dois lados, trocar os meios
+_EQ_MOVES = ((2, 3, 0, 1), (1, 0, 3, 2), (0, 2, 1, 3))
+
+def canonical_fact(fact):
+    """
+    Forma canônica de um fato, igual para todas as formas de escrever o
+    mesmo predicado (ex: ('cong', 'B', 'M', 'M', 'C') e
+    ('cong', 'C', 'M', 'B', 'M')). Predicados sem simetrias conhecidas
+    são devolvidos inalterados.
+    """
+    name, args = fact[0], fact[1:]
+    if name in ('coll', 'cyclic'):
+        return (name, *sorted(args))
+    if name in ('cong', 'para', 'perp') and len(args) == 4:
+        pairs = sorted(tuple(sorted(args[i:i + 2])) for i in (0, 2))
+        return (name, *pairs[0], *pairs[1])
+    if name in ('eqangle', 'eqratio') and len(args) == 8:
+        pairs = tuple(tuple(sorted(args[i:i + 2])) for i in range(0, 8, 2))
+        return (name, *(x for pair in _orbit_min(pairs, _EQ_MOVES) for x in pair))
+    return tuple(fact)
+
 class DDARAdapter:
     def __init__(self, points_dict):
         """
@@ -49,6 +84,7 @@ class DDARAdapter:
         self.ddar = DDAR(points_list)
         self.added_facts = []  # fatos adicionados como givens
         self.given_predicates = []  # AGPredicates dos givens
+        self.given_constraints = {}  # id de restrição no DDAR -> fato
         
     def add_fact(self, fact):
         """
@@ -58,17 +94,22 @@ class DDARAdapter:
         self.added_facts.append(fact)
         try:
             pred = fact_to_predicate(fact, self.points_dict)
-            self.ddar.force_pred(pred)
+            cid = self.ddar.force_pred(pred)
             self.given_predicates.append(pred)
+            if cid is not None:
+                self.given_constraints[cid] = fact
         except Exception as e:
             # Se houver erro ao forçar (ex: pontos não numéricos), apenas armazena
             pass
 
-    def run(self):
+    def run(self, budget=None):
         """
         Executa a dedução closure no DDAR.
+        budget: ddar.Budget opcional (tempo, rodadas, tamanhos).
+        Retorna o status ('fixpoint' ou o limite que interrompeu a closure).
         """
-        self.ddar.deduction_closure(verbose=False, progress_dot=False)
+        return self.ddar.deduction_closure(
+            verbose=False, progress_dot=False, budget=budget)
 
     def _predicate_equal(self, pred1, pred2):
         """Compara dois AGPredicates para igualdade."""
@@ -102,65 +143,35 @@ class DDARAdapter:
             # Silenciosamente falhar - o fato pode não ser válido para esse estado
             return False
 
-    def _generate_candidate_facts(self):
-        """
-        Gera candidatos para fatos deduzidos baseados nos pontos disponíveis.
-        Retorna lista de tuplas (pred_name, args).
-        
-        eqangle(a1, a2, b1, b2, c1, c2, d1, d2) significa:
-        ângulo entre direção (a1,a2) e (b1,b2) = ângulo entre (c1,c2) e (d1,d2)
-        
-        Para ângulo ∠ABC (vértice B, entre AB e BC):
-        eqangle(A, B, B, C, ...) representa direção AB e direção BC
-        """
-        candidates = []
-        points = list(self.points_dict.keys())
-        
-        # Gerar candidatos para eqangle (igualdade de ângulos)
-        if len(points) >= 3:
-            # Testar várias combinações de triplas
-            for i, A in enumerate(points):
-                for j, B in enumerate(points):
-                    if i == j:
-                        continue
-                    for k, C in enumerate(points):
-                        if k == i or k == j:
-                            continue
-                        # eqangle(A, B, B, C, A, C, C, B) - ∠ABC = ∠ACB
-                        # (direção AB → BC) = (direção AC → CB)
-                        candidates.append(("eqangle", A, B, B, C, A, C, C, B))
-                        # eqangle(B, A, A, C, B, C, C, A) - ∠BAC = ∠BCA
-                        candidates.append(("eqangle", B, A, A, C, B, C, C, A))
-                        # eqangle(C, A, A, B, C, B, B, A) - ∠CAB = ∠CBA
-                        candidates.append(("eqangle", C, A, A, B, C, B, B, A))
-        
-        return candidates
-
-    def all_facts(self):
+    def all_facts(self, kinds=None):
         """
         Retorna lista de fatos conhecidos (givens + deduzidos).
-        Descobre fatos deduzidos testando candidatos.
+        Os fatos deduzidos são lidos diretamente do estado do DDAR
+        (DDAR.enumerate_facts), sem gerar e testar candidatos.
+        kinds: nomes de predicados opcionais para restringir os deduzidos.
         """
         all_known = list(self.added_facts)
-        
-        # Gerar e testar candidatos
-        candidates = self._generate_candidate_facts()
-        for candidate in candidates:
-            if self._check_deduced_fact(candidate):
-                # Evitar duplicatas
-                if candidate not in all_known:
-                    all_known.append(candidate)
-        
+        # Comparar a menos das simetrias, para não devolver um given
+        # reescrito como se fosse deduzido
+        seen = {canonical_fact(fact) for fact in all_known}
+        for pred in self.ddar.enumerate_facts(kinds):
+            fact = (pred.name, *(point.name for point in pred.points))
+            key = canonical_fact(fact)
+            # Evitar duplicatas
+            if key not in seen:
+                seen.add(key)
+                all_known.append(fact)
+
         return all_known
 
     def get_proof(self, target_fact):
         """
-        Retorna a prova mínima via traceback.
-        Por enquanto, retorna lista vazia.
-        TODO: implementar traceback real do DDAR
+        Retorna os givens dos quais o fato depende, via traceback das
+        restrições do DDAR (lista vazia se o fato não foi deduzido).
         """
-        # TODO: implementar traceback real do DDAR
-        # Por enquanto, se o fato foi deduzido, retornar os givens como "prova"
-        if self._check_deduced_fact(target_fact):
-            return self.added_facts.copy()
-        return []
+        if not self._check_deduced_fact(target_fact):
+            return []
+        pred = fact_to_predicate(target_fact, self.points_dict)
+        used = self.ddar.traceback(pred)
+        return [self.given_constraints[cid] for cid in used
+                if cid in self.given_constraints]